@@ -0,0 +1,248 @@
+"""
+Admission control in front of the API calls.
+
+Every call is charged to the user and guild of the interaction it serves (token buckets).
+Calls to heavy endpoints then wait for a free slot of their backend service in a fair queue,
+served round-robin across users so one user's burst can't starve the others.
+Cheap endpoints take the fast lane and skip the queue.
+"""
+import asyncio
+import contextlib
+import contextvars
+import errors
+import health
+import logging
+import status
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Interaction being served by the current task, set when a slash command starts
+current_interaction: contextvars.ContextVar = contextvars.ContextVar("current_interaction", default=None)
+
+def bind(interaction):
+	"""Charge the API calls made by the current task to this interaction's user and guild"""
+	current_interaction.set(interaction)
+
+class TokenBucket:
+	"""Allow rate calls per second on average, with bursts of up to capacity calls"""
+	def __init__(self, rate: float, capacity: float):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated_at = time.monotonic()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+		self.updated_at = now
+
+	def retry_after(self, cost: float = 1) -> float:
+		"""Seconds until cost tokens are available (0 if they already are)"""
+		self._refill()
+		if self.tokens >= cost:
+			return 0
+		return (cost - self.tokens) / self.rate
+
+	def take(self, cost: float = 1):
+		self.tokens -= cost
+
+	def full(self) -> bool:
+		self._refill()
+		return self.tokens >= self.capacity
+
+class FairLimiter:
+	"""
+	Allow at most limit concurrent holders.
+	Waiters are served round-robin across keys (users), first come first served within a key.
+	"""
+	def __init__(self, limit: int, max_waiting: int):
+		self.limit = limit
+		self.max_waiting = max_waiting
+		self.active = 0
+		self.queues: "OrderedDict[object, Deque[asyncio.Future]]" = OrderedDict()
+		# Position listeners of the waiters, with the last position they were told
+		self.listeners: Dict[asyncio.Future, list] = {}
+
+	@property
+	def waiting(self) -> int:
+		return sum(len(queue) for queue in self.queues.values())
+
+	def position(self, future: asyncio.Future) -> int:
+		"""1-based place of a waiter in the round-robin serving order"""
+		keys = list(self.queues)
+		for rank, key in enumerate(keys):
+			queue = self.queues[key]
+			if future in queue:
+				index = queue.index(future)
+				# Every key serves index waiters before this one's turn comes, keys earlier in the rotation one more
+				ahead = sum(min(len(other), index) for other in self.queues.values())
+				ahead += sum(1 for earlier in keys[:rank] if len(self.queues[earlier]) > index)
+				return ahead + 1
+		return 0
+
+	async def acquire(self, key, on_position: Optional[Callable[[int], Awaitable[None]]] = None):
+		"""Wait for a slot; on_position is awaited with the queue position whenever it changes"""
+		if self.active < self.limit and not self.queues:
+			self.active += 1
+			return
+		if self.waiting >= self.max_waiting:
+			raise errors.QueueFullError("Roby is very busy right now, please try again in a few minutes.")
+		future = asyncio.get_running_loop().create_future()
+		self.queues.setdefault(key, deque()).append(future)
+		if on_position:
+			self.listeners[future] = [on_position, 0]
+		self._notify()
+		try:
+			await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				# Granted just as the waiter gave up
+				self.release()
+			else:
+				self._remove(key, future)
+			raise
+		finally:
+			self.listeners.pop(future, None)
+
+	def release(self):
+		self.active -= 1
+		self._wake()
+
+	def _remove(self, key, future: asyncio.Future):
+		queue = self.queues.get(key)
+		if queue and future in queue:
+			queue.remove(future)
+			if not queue:
+				del self.queues[key]
+		self._notify()
+
+	def _wake(self):
+		while self.active < self.limit and self.queues:
+			key, queue = next(iter(self.queues.items()))
+			future = queue.popleft()
+			if queue:
+				# Next turn goes to the next user
+				self.queues.move_to_end(key)
+			else:
+				del self.queues[key]
+			if future.done():
+				continue
+			self.active += 1
+			future.set_result(None)
+		self._notify()
+
+	def _notify(self):
+		for future, listener in list(self.listeners.items()):
+			position = self.position(future)
+			if position and position != listener[1]:
+				listener[1] = position
+				task = asyncio.ensure_future(listener[0](position))
+				task.add_done_callback(_log_failure)
+
+def _log_failure(task: asyncio.Task):
+	if not task.cancelled() and task.exception():
+		logger.warning(f"Queue position update failed: {task.exception()}")
+
+# Token buckets, by user and guild id
+user_buckets: Dict[int, TokenBucket] = {}
+guild_buckets: Dict[int, TokenBucket] = {}
+
+# Concurrency limiters, by service name
+limiters: Dict[str, FairLimiter] = {}
+
+# Interactions already charged (a command is charged once, however many calls it makes, e.g. after a fallback),
+# and interactions whose original response shows the queue status, by interaction id (most recent last)
+MAX_TRACKED = 10000
+charged: "OrderedDict[int, None]" = OrderedDict()
+status_shown: "OrderedDict[int, None]" = OrderedDict()
+
+def _track(interactions: "OrderedDict[int, None]", interaction_id: int):
+	interactions[interaction_id] = None
+	if len(interactions) > MAX_TRACKED:
+		interactions.popitem(last=False)
+
+def take_status(interaction) -> bool:
+	"""
+	Whether the original response shows the queue status, which the answer should then replace.
+	Only the first caller gets True.
+	"""
+	if interaction.id not in status_shown:
+		return False
+	del status_shown[interaction.id]
+	return True
+
+def is_fast(endpoint: str) -> bool:
+	"""Whether an endpoint takes the fast lane (no queue)"""
+	return endpoint in status.get_state("fast-endpoints")
+
+def _bucket(buckets: Dict[int, TokenBucket], key: int, rate: str, burst: str) -> TokenBucket:
+	if key not in buckets:
+		# Drop idle buckets now and then so the dicts don't grow forever
+		if len(buckets) > 10000:
+			for old_key in [old_key for old_key, bucket in buckets.items() if bucket.full()]:
+				del buckets[old_key]
+		buckets[key] = TokenBucket(status.get_state(rate), status.get_state(burst))
+	return buckets[key]
+
+def check(endpoint: str):
+	"""
+	Charge the current interaction's first call to its user and guild.
+	Raises errors.RateLimitedError if either is over its rate limit.
+	"""
+	interaction = current_interaction.get()
+	if interaction is None or interaction.id in charged:
+		return
+	buckets = [_bucket(user_buckets, interaction.user.id, "user-rate", "user-burst")]
+	if interaction.guild_id is not None:
+		buckets.append(_bucket(guild_buckets, interaction.guild_id, "guild-rate", "guild-burst"))
+	retry_after = max(bucket.retry_after() for bucket in buckets)
+	if retry_after > 0:
+		raise errors.RateLimitedError(retry_after)
+	for bucket in buckets:
+		bucket.take()
+	_track(charged, interaction.id)
+
+def limiter(service: str) -> FairLimiter:
+	if service not in limiters:
+		limits = status.get_state("service-concurrency")
+		limiters[service] = FairLimiter(limits.get(service, limits["API"]), status.get_state("queue-limit"))
+	return limiters[service]
+
+@contextlib.asynccontextmanager
+async def slot(endpoint: str):
+	"""
+	Hold a slot of the endpoint's service while calling it.
+	Heavy endpoints wait their turn and show the user their queue position in the original response,
+	which the answer then replaces (see take_status).
+	"""
+	if is_fast(endpoint):
+		yield
+		return
+	interaction = current_interaction.get()
+	service_limiter = limiter(health.service_for(endpoint))
+	key = interaction.user.id if interaction is not None else None
+	queued = False
+
+	async def on_position(position: int):
+		nonlocal queued
+		queued = True
+		if interaction is not None:
+			await interaction.edit_original_response(content=f"⏳ You're #{position} in the queue")
+			_track(status_shown, interaction.id)
+
+	await service_limiter.acquire(key, on_position)
+	try:
+		if queued and interaction is not None:
+			with contextlib.suppress(Exception):
+				await interaction.edit_original_response(content="⚙️ Working on it…")
+		yield
+	finally:
+		service_limiter.release()
+
+async def admit(endpoint: str, call: Callable[[], Awaitable]):
+	"""Run a call once it holds a slot of its service"""
+	async with slot(endpoint):
+		return await call()
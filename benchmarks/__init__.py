@@ -0,0 +1,3 @@
+"""
+Load-test and benchmark harness for the bot's callbacks, runnable without Discord or the Domestic AI stack.
+"""
@@ -0,0 +1,143 @@
+"""
+Stand-in for the Domestic API's api/* routes, with configurable latency, payload size and error rate.
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+from aiohttp import web
+from dataclasses import dataclass
+
+@dataclass
+class FakeAPIConfig:
+	latency: float = 0.01 # seconds per request
+	jitter: float = 0.0 # extra random seconds per request, up to this value
+	error_rate: float = 0.0 # fraction of requests answered with a 500 HTML page
+	image_size: int = 512 * 1024 # bytes of the fake PNG returned by api/image and api/rembg
+	binary_images: bool = True # answer image/png when asked, otherwise base64 in JSON
+	stream_chunks: int = 20 # SSE chunks in a streamed api/roby answer
+	text_size: int = 400 # characters in text answers
+
+TEXT_RESULTS = {
+	"beep": "bop",
+	"bop": "beep",
+	"ping": "pong",
+	"thanks": "You're welcome!",
+}
+
+class FakeAPI:
+	"""aiohttp application answering like the Domestic API"""
+	def __init__(self, config: FakeAPIConfig):
+		self.config = config
+		self.requests = 0
+		self.image = b"\x89PNG\r\n\x1a\n" + os.urandom(max(config.image_size - 8, 0))
+		self.app = web.Application(client_max_size=64 * 1024 * 1024)
+		self.app.router.add_get("/endpoints", self.endpoints)
+		self.app.router.add_post("/api/btc", self.currency)
+		self.app.router.add_post("/api/eth", self.currency)
+		self.app.router.add_post("/api/flip", self.flip)
+		self.app.router.add_post("/api/throw", self.throw)
+		self.app.router.add_post("/api/joke", self.joke)
+		self.app.router.add_post("/api/image", self.generate_image)
+		self.app.router.add_post("/api/rembg", self.rembg)
+		self.app.router.add_post("/api/rembg/upload", self.rembg_upload)
+		self.app.router.add_post("/api/roby", self.roby)
+		for name in ("haiku", "wdyt", "wisdom"):
+			self.app.router.add_post(f"/api/{name}", self.text)
+		for name in TEXT_RESULTS:
+			self.app.router.add_post(f"/api/{name}", self.text)
+		self.runner = None
+
+	async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+		"""Start serving and return the base URL"""
+		self.runner = web.AppRunner(self.app, access_log=None)
+		await self.runner.setup()
+		site = web.TCPSite(self.runner, host, port)
+		await site.start()
+		port = site._server.sockets[0].getsockname()[1]
+		return f"http://{host}:{port}/"
+
+	async def stop(self):
+		if self.runner is not None:
+			await self.runner.cleanup()
+
+	async def _work(self):
+		"""Simulate backend latency, raising a 500 for a fraction of requests"""
+		self.requests += 1
+		await asyncio.sleep(self.config.latency + random.uniform(0, self.config.jitter))
+		if random.random() < self.config.error_rate:
+			raise web.HTTPInternalServerError(text="<html><body>Internal Server Error</body></html>", content_type="text/html")
+
+	def _text(self) -> str:
+		return ("lorem ipsum " * (self.config.text_size // 12 + 1))[:self.config.text_size]
+
+	async def endpoints(self, request):
+		await self._work()
+		return web.json_response({"endpoints": ["api/" + route.resource.canonical.split("/api/")[-1] for route in self.app.router.routes() if "/api/" in route.resource.canonical]})
+
+	async def currency(self, request):
+		await self._work()
+		return web.json_response({"result": f"{random.uniform(1000, 100000):.2f}"})
+
+	async def flip(self, request):
+		await self._work()
+		return web.json_response({"result": random.choice(["Heads", "Tails"])})
+
+	async def throw(self, request):
+		await self._work()
+		body = await request.json()
+		return web.json_response({"result": str(random.randint(1, int(body["faces"])))})
+
+	async def joke(self, request):
+		await self._work()
+		return web.json_response({"result": {"question": "Why?", "answer": self._text()}})
+
+	async def text(self, request):
+		await self._work()
+		name = request.path.rsplit("/", 1)[-1]
+		return web.json_response({"result": TEXT_RESULTS.get(name) or self._text()})
+
+	async def _image_response(self, request, metadata: dict):
+		if self.config.binary_images and "image/png" in request.headers.get("Accept", ""):
+			headers = {f"X-{key.replace('_', '-').title()}": str(value) for key, value in metadata.items()}
+			return web.Response(body=self.image, content_type="image/png", headers=headers)
+		return None
+
+	async def generate_image(self, request):
+		await self._work()
+		metadata = {"generation_time": self.config.latency, "total_energy_nespresso": 0.01}
+		response = await self._image_response(request, metadata)
+		if response is not None:
+			return response
+		return web.json_response({"result": dict(metadata, b64=base64.b64encode(self.image).decode())})
+
+	async def rembg(self, request):
+		await self._work()
+		return await self._rembg_result(request)
+
+	async def rembg_upload(self, request):
+		await self._work()
+		form = await request.post()
+		form["image"].file.read()
+		return await self._rembg_result(request)
+
+	async def _rembg_result(self, request):
+		response = await self._image_response(request, {})
+		if response is not None:
+			return response
+		return web.json_response({"result": base64.b64encode(self.image).decode()})
+
+	async def roby(self, request):
+		await self._work()
+		body = await request.json()
+		if not body.get("stream") or "text/event-stream" not in request.headers.get("Accept", ""):
+			return web.json_response({"result": self._text()})
+		response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+		await response.prepare(request)
+		text = self._text()
+		size = max(len(text) // self.config.stream_chunks, 1)
+		for start in range(0, len(text), size):
+			await response.write(f"data: {json.dumps({'token': text[start:start + size]})}\n\n".encode())
+		await response.write(b"data: [DONE]\n\n")
+		return response
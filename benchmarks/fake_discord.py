@@ -0,0 +1,92 @@
+"""
+Fake discord.Interaction that records what callbacks do with it, with no Discord connection.
+"""
+import itertools
+import time
+from types import SimpleNamespace
+
+_ids = itertools.count(1)
+
+class FakeMessage:
+	def __init__(self, kwargs: dict):
+		self.id = next(_ids)
+		self.kwargs = kwargs
+		self.edits = 0
+
+	async def edit(self, **kwargs):
+		self.kwargs.update(kwargs)
+		self.edits += 1
+		return self
+
+class FakeResponse:
+	def __init__(self, interaction: "FakeInteraction"):
+		self.interaction = interaction
+		self.done = False
+
+	def is_done(self) -> bool:
+		return self.done
+
+	async def defer(self, **kwargs):
+		self.interaction.deferred_at = time.perf_counter()
+		self.done = True
+
+	async def send_message(self, content=None, **kwargs):
+		self.done = True
+		self.interaction.record(dict(kwargs, content=content))
+
+class FakeFollowup:
+	def __init__(self, interaction: "FakeInteraction"):
+		self.interaction = interaction
+
+	async def send(self, content=None, **kwargs):
+		return self.interaction.record(dict(kwargs, content=content))
+
+class FakeAttachment:
+	"""Stand-in for discord.Attachment holding the image bytes in memory"""
+	def __init__(self, data: bytes, content_type: str = "image/png", width: int = 1024, height: int = 1024):
+		self.id = next(_ids)
+		self.data = data
+		self.size = len(data)
+		self.content_type = content_type
+		self.width = width
+		self.height = height
+		self.url = f"https://cdn.example.invalid/attachments/{self.id}/image.png"
+		self.proxy_url = f"https://media.example.invalid/attachments/{self.id}/image.png"
+
+	async def read(self) -> bytes:
+		return self.data
+
+class FakeInteraction:
+	"""
+	Stand-in for discord.Interaction as used by callbacks.py.
+	Records when it was deferred and when each reply was sent.
+	"""
+	type = SimpleNamespace(name="application_command")
+
+	def __init__(self, command: str, user_id: int = 1, guild_id: int = 1):
+		self.id = next(_ids)
+		self.command = SimpleNamespace(name=command, qualified_name=command)
+		self.data = {"name": command}
+		self.user = SimpleNamespace(id=user_id, name=f"user{user_id}", display_avatar=SimpleNamespace(url="https://example.invalid/avatar.png"))
+		self.guild_id = guild_id
+		self.guild = SimpleNamespace(id=guild_id)
+		self.channel_id = 1
+		self.message = None
+		self.created_at = time.perf_counter()
+		self.deferred_at = None
+		self.replied_at = None
+		self.messages = []
+		self.response = FakeResponse(self)
+		self.followup = FakeFollowup(self)
+
+	def record(self, kwargs: dict) -> FakeMessage:
+		message = FakeMessage(kwargs)
+		self.messages.append(message)
+		self.replied_at = time.perf_counter()
+		return message
+
+	async def edit_original_response(self, **kwargs):
+		self.replied_at = time.perf_counter()
+		if self.messages:
+			return await self.messages[0].edit(**kwargs)
+		return self.record(kwargs)
@@ -0,0 +1,157 @@
+"""
+Fire concurrent calls through the real callbacks against the stand-in API and report latency, throughput and memory.
+
+Usage (from the repository root):
+	python -m benchmarks.run --requests 2000 --concurrency 200 --latency 0.05
+"""
+import argparse
+import asyncio
+import logging
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import admission
+import cache
+import callbacks
+import functions
+import status
+from benchmarks.fake_api import FakeAPI, FakeAPIConfig
+from benchmarks.fake_discord import FakeAttachment, FakeInteraction
+
+# How each command calls its callback; n is the request number
+SCENARIOS = {
+	"beep": lambda interaction, n, unique: callbacks.basic("beep", interaction),
+	"ping": lambda interaction, n, unique: callbacks.basic("ping", interaction),
+	"flip": lambda interaction, n, unique: callbacks.basic("flip", interaction),
+	"wisdom": lambda interaction, n, unique: callbacks.basic("wisdom", interaction),
+	"btc": lambda interaction, n, unique: callbacks.currency("btc", interaction),
+	"throw": lambda interaction, n, unique: callbacks.throw(interaction, 6),
+	"joke": lambda interaction, n, unique: callbacks.joke(interaction),
+	"haiku": lambda interaction, n, unique: callbacks.haiku(interaction, f"topic {n % unique}"),
+	"roby": lambda interaction, n, unique: callbacks.roby(interaction, f"question {n % unique}"),
+	"image": lambda interaction, n, unique: callbacks.image(interaction, f"prompt {n % unique}"),
+	"rembg": lambda interaction, n, unique: callbacks.rembg(interaction, attachment=FakeAttachment(source_image(n % unique))),
+	"rembg-url": lambda interaction, n, unique: callbacks.rembg(interaction, image_url=f"https://example.invalid/{n % unique}.png"),
+}
+
+def source_image(n):
+	"""Small distinct PNG-signed payload standing in for an attachment"""
+	return b"\x89PNG\r\n\x1a\n" + n.to_bytes(8, "big") * 4096
+
+def percentile(values, fraction):
+	if not values:
+		return float("nan")
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+async def run_command(command, requests, concurrency, unique, rate_limits=False):
+	"""Run one command's scenario and return its measurements"""
+	scenario = SCENARIOS[command]
+	semaphore = asyncio.Semaphore(concurrency)
+	latencies = []
+	defers = []
+	errors = 0
+
+	async def one(n):
+		nonlocal errors
+		async with semaphore:
+			interaction = FakeInteraction(command, user_id=n % 500, guild_id=n % 20)
+			if rate_limits:
+				# What the command tree's interaction_check does
+				admission.bind(interaction)
+			try:
+				await scenario(interaction, n, unique)
+			except Exception:
+				errors += 1
+				return
+			if interaction.replied_at is None:
+				errors += 1
+				return
+			latencies.append(interaction.replied_at - interaction.created_at)
+			if interaction.deferred_at is not None:
+				defers.append(interaction.deferred_at - interaction.created_at)
+
+	if tracemalloc.is_tracing():
+		tracemalloc.reset_peak()
+	started_at = time.perf_counter()
+	await asyncio.gather(*(one(n) for n in range(requests)))
+	elapsed = time.perf_counter() - started_at
+	peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+	return {
+		"command": command,
+		"ok": len(latencies),
+		"errors": errors,
+		"p50": percentile(latencies, 0.5),
+		"p99": percentile(latencies, 0.99),
+		"mean": statistics.fmean(latencies) if latencies else float("nan"),
+		"defer_p99": percentile(defers, 0.99),
+		"throughput": len(latencies) / elapsed if elapsed else 0,
+		"peak_mb": peak / 2**20 if peak is not None else float("nan"),
+	}
+
+def print_report(results, api_requests):
+	header = f"{'command':<9} {'ok':>6} {'err':>5} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8} {'defer p99':>10} {'req/s':>8} {'peak MB':>8}"
+	print(header)
+	print("-" * len(header))
+	for r in results:
+		print(f"{r['command']:<9} {r['ok']:>6} {r['errors']:>5} {r['p50'] * 1000:>8.1f} {r['p99'] * 1000:>8.1f} {r['mean'] * 1000:>8.1f} {r['defer_p99'] * 1000:>10.2f} {r['throughput']:>8.0f} {r['peak_mb']:>8.1f}")
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# ru_maxrss is in bytes on macOS and kilobytes on Linux
+	maxrss_mb = maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+	print(f"\nUpstream requests served by the stand-in API: {api_requests}")
+	print(f"Process max RSS: {maxrss_mb:.1f} MB")
+
+async def main(args):
+	api = FakeAPI(FakeAPIConfig(
+		latency=args.latency,
+		jitter=args.jitter,
+		error_rate=args.error_rate,
+		image_size=args.image_size,
+		binary_images=not args.json_images,
+		text_size=args.text_size,
+	))
+	functions.api_url = await api.start()
+	await functions.open_session()
+	# Keep cached results out of the working tree
+	cache_dir = tempfile.mkdtemp(prefix="roby-bench-")
+	status.set_state("result-cache-enabled", args.result_cache)
+	functions.result_cache = cache.DiskLRU(cache_dir, status.get_state("result-cache-max-bytes"))
+	if args.memory:
+		tracemalloc.start()
+	results = []
+	try:
+		for command in args.commands:
+			results.append(await run_command(command, args.requests, args.concurrency, args.unique, args.rate_limits))
+	finally:
+		await functions.close_session()
+		await api.stop()
+		shutil.rmtree(cache_dir, ignore_errors=True)
+	print_report(results, api.requests)
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--commands", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS), help="commands to benchmark")
+	parser.add_argument("--requests", type=int, default=1000, help="calls per command")
+	parser.add_argument("--concurrency", type=int, default=100, help="calls in flight at once")
+	parser.add_argument("--unique", type=int, default=10**9, help="distinct prompts per command (lower it to exercise coalescing)")
+	parser.add_argument("--latency", type=float, default=0.01, help="stand-in API latency in seconds")
+	parser.add_argument("--jitter", type=float, default=0.0, help="extra random stand-in API latency in seconds")
+	parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stand-in API requests failing with a 500")
+	parser.add_argument("--image-size", type=int, default=512 * 1024, help="bytes per generated image")
+	parser.add_argument("--text-size", type=int, default=400, help="characters per text answer")
+	parser.add_argument("--json-images", action="store_true", help="answer images as base64 in JSON instead of image/png")
+	parser.add_argument("--rate-limits", action="store_true", help="charge calls to per-user and per-guild rate limits (500 users, 20 guilds)")
+	parser.add_argument("--result-cache", action="store_true", help="enable the on-disk /image and /rembg result cache")
+	parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip tracemalloc peak memory tracking (it slows the run)")
+	parser.add_argument("--verbose", action="store_true", help="show the bot's logs")
+	return parser.parse_args(argv)
+
+if __name__ == "__main__":
+	args = parse_args()
+	logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+	asyncio.run(main(args))
@@ -1,11 +1,24 @@
+import coldstart # first, so the startup trace includes the other imports
+import admission
 import aiohttp
+import argparse
 import asyncio
+import catalogue
+import cluster
+import commandsync
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
-import dotenv
 import callbacks
+import errors
+import functions
+import gateway
+import health
 import logging
+import logs
+import math
+import metrics
+import pregen
 import os
 import startup
 import status
@@ -13,9 +26,11 @@ import subprocess
 import sys
 import time
 import traceback
+import warmup
 from typing import Optional
 
-dotenv.load_dotenv()
+# Cluster workers get their shards and settings from the coordinator
+cluster.join()
 
 logger = logging.getLogger('discord')
 
@@ -26,10 +41,24 @@ API_URL = f"http://{API_HOST}:{API_PORT}"
 STARTUP_TIMEOUT = 60
 
 # Bot settings
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-bot = commands.Bot(command_prefix=status.get_state("prefix"), intents=intents)
+class RobyTree(app_commands.CommandTree):
+	async def interaction_check(self, interaction: discord.Interaction) -> bool:
+		# Runs in the command's task, so its API calls are charged to this user and guild
+		admission.bind(interaction)
+		# Before the callback, so its defer() finds the command (on_interaction is dispatched after the command task starts)
+		if interaction.type == discord.InteractionType.application_command:
+			metrics.command_received(interaction)
+		return True
+
+bot_options = dict(command_prefix=status.get_state("prefix"), tree_cls=RobyTree, **gateway.options(status.get_state("cache-profile")))
+if status.get_state("sharded"):
+	bot = commands.AutoShardedBot(shard_count=status.get_state("shard-count"), shard_ids=status.get_state("shard-ids"), **bot_options)
+else:
+	bot = commands.Bot(**bot_options)
+
+def syncs_commands():
+	"""Whether this process syncs the command tree: in a cluster, the first worker does it for all of them"""
+	return status.get_state("cluster-worker") in (None, 0)
 
 async def ping_port(port):
 	"""Ping a port to check if it's available"""
@@ -47,6 +76,14 @@ async def wait_for_api():
 async def start_tools():
     """Start the tools"""
     return await startup.start_tools()
+@bot.event
+async def setup_hook():
+	"""Open the shared API session and the metrics endpoint, and register the cached catalogue commands, before connecting to Discord."""
+	with coldstart.span("setup hook"):
+		await functions.open_session()
+		await metrics.start_server()
+		catalogue.load(bot.tree)
+
 # Remove default help command
 bot.remove_command('help')
 
@@ -92,31 +129,16 @@ async def haiku(interaction: discord.Interaction, about: str):
 @bot.tree.command(name="help", description="🛟 All commands")
 async def help(interaction: discord.Interaction):
 	logger.info(f"Help command called")
-	await interaction.response.defer()
-
-	# Get all registered commands
-	commands = bot.tree.get_commands()
-	
-	# Sort commands alphabetically by name
-	commands.sort(key=lambda x: x.name)
-
-	# Create embed
-	embed = discord.Embed(title="Available Commands", color=0x00ff00)
-	
-	# Add each command to embed
-	for cmd in commands:
-		name = cmd.name
-		desc = cmd.description if cmd.description else "No description available"
-		embed.add_field(name=f"/{name}", value=desc, inline=False)
-
-	await interaction.followup.send(embed=embed)
+	await callbacks.defer(interaction)
+	# Built once from the command tree (hand-written and catalogue commands) and rebuilt when the catalogue changes
+	await interaction.followup.send(embed=catalogue.help_embed(bot.tree))
 
 #image
 @bot.tree.command(name="image", description="🎨 Generate an image")
-@app_commands.describe(prompt="The prompt for the image")
-async def image(interaction: discord.Interaction, prompt: str):
+@app_commands.describe(prompt="The prompt for the image", seed="Seed for a reproducible image (optional)")
+async def image(interaction: discord.Interaction, prompt: str, seed: Optional[int] = None):
 	logger.info(f"Image command called with prompt: {prompt}")
-	await callbacks.image(interaction, prompt)
+	await callbacks.image(interaction, prompt, seed)
 
 #joke
 @bot.tree.command(name="joke", description="🤡 Tell me a joke")
@@ -186,42 +208,168 @@ async def list_commands(ctx):
 	command_list = sorted([cmd.name for cmd in bot.commands])
 	await ctx.send(f"Available commands ({len(command_list)}): {', '.join(command_list)}")
 
-@tasks.loop(seconds=55)
+# Command to force a command tree sync (owner only)
+@bot.command(name="sync")
+@commands.is_owner()
+async def sync_commands(ctx):
+	synced = await commandsync.sync_tree(bot, force=True, guild_id=status.get_state("dev-guild-id"))
+	await ctx.send(f"Synced {len(synced)} command(s)")
+
+# Command to check the cache, coalescing, pre-generation and warm-keeping counters (for tuning them)
+@bot.command(name="cachestats")
+async def cache_stats(ctx):
+	stats = functions.quote_cache.stats()
+	results = functions.result_cache.stats()
+	pools = ", ".join(f"{name} ({pool['ready']})" for name, pool in pregen.stats().items())
+	models = ", ".join(f"{endpoint} cold {entry['cold']}, warm {entry['warm']}, {entry['warm-ups']} warm-ups" for endpoint, entry in warmup.stats().items())
+	await ctx.send(
+		f"Quote cache: {stats['hits']} hits, {stats['stale_hits']} stale hits, {stats['misses']} misses, {stats['coalesced']} coalesced ({stats['hit_rate']:.0%} hit rate)\n"
+		f"Generations coalesced: {functions.generation_flight.shared}\n"
+		f"Result cache: {results['hits']} hits, {results['misses']} misses, {results['shared']} shared ({results['hit_rate']:.0%} hit rate), {results['bytes_saved'] / 2**20:.1f} MB saved, {results['bytes'] / 2**20:.1f} MB stored\n"
+		f"Pre-generated answers ready: {pools or 'none'}\n"
+		f"Model latency: {models or 'none'}"
+	)
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+	warmup.command_finished(interaction)
+	metrics.command_finished(interaction)
+
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+	"""Handle slash command errors"""
+	warmup.command_finished(interaction, error=True)
+	metrics.command_finished(interaction, error=True)
+	original = getattr(error, "original", error)
+	if isinstance(original, errors.ServiceUnavailableError):
+		logger.warning(f"/{interaction.command.name if interaction.command else '?'} refused: {original}")
+		if health.breaker(original.service).state == health.STARTING:
+			message = f"😴 {original.service} is still starting up, please try again in a bit."
+		else:
+			message = f"😴 {original.service} is not available right now, please try again in a bit."
+	elif isinstance(original, errors.AdmissionError):
+		logger.info(f"Slash command turned away: {original}")
+		message = str(original)
+	elif isinstance(original, errors.APITimeoutError):
+		logger.warning(f"Slash command timed out: {original}")
+		message = "⌛ Roby took too long to answer, please try again later."
+	elif isinstance(original, errors.APIError):
+		logger.error(f"Slash command API error: {original}")
+		message = "🤕 Something went wrong on Roby's side, please try again later."
+	else:
+		logger.error(f"Slash command error in {interaction.command.name if interaction.command else '?'}: {original}")
+		logger.error("".join(traceback.format_exception(original)))
+		message = f"Error: {str(original)}"
+	if admission.take_status(interaction):
+		# Replace the queue status, rather than leave it behind
+		await interaction.edit_original_response(content=message)
+	elif interaction.response.is_done():
+		await interaction.followup.send(message, ephemeral=True)
+	else:
+		await interaction.response.send_message(message, ephemeral=True)
+
+@tasks.loop(seconds=status.get_state("health-interval"))
 async def routine_function():
 	"""
-	Example routine function.
-	Runs every 55 seconds.
+	Health monitor, pre-generation and warm-keeping.
+	Probes every service, updates its circuit breaker and restarts the dead ones,
+	then starts refilling the pre-generated answer pools while the backend is idle,
+	and the warm-ups that keep the models in use loaded.
 	"""
-	logger.info("I'm alive")
+	session = await functions.get_session()
+	await health.check_services(startup.services, session)
+	# In the background, so a long generation doesn't hold up the next health check
+	pregen.start_refill(functions.api_POST_live)
+	await warmup.tick(functions.api_POST_live, functions.api_POST_image, startup.services, session)
 	
 @routine_function.before_loop
 async def before_routine_function():
 	"""Wait for bot to be ready before starting routine_function loop."""
 	await bot.wait_until_ready()
 
+@tasks.loop(seconds=status.get_state("catalogue-interval"))
+async def catalogue_refresh():
+	"""
+	Reload the endpoint catalogue.
+	Commands are added, updated or removed without a restart, then synced.
+	"""
+	try:
+		if await catalogue.refresh(bot.tree) and syncs_commands():
+			synced = await commandsync.sync_tree(bot, guild_id=status.get_state("dev-guild-id"))
+			if synced is not None:
+				logger.info(f"Synced {len(synced)} command(s) after a catalogue change")
+	except Exception as e:
+		logger.error(f"Failed to reload the endpoint catalogue: {e}")
+
+@tasks.loop(seconds=status.get_state("shard-latency-interval"))
+async def shard_report():
+	"""Report the gateway heartbeat latency of each shard this process runs"""
+	latencies = bot.latencies if isinstance(bot, commands.AutoShardedBot) else [(bot.shard_id or 0, bot.latency)]
+	report = []
+	for shard_id, latency in latencies:
+		# No heartbeat acknowledged yet
+		if math.isfinite(latency):
+			metrics.shard_latency_seconds.set(str(shard_id), value=latency)
+			report.append(f"{shard_id}: {latency * 1000:.0f} ms")
+	if report:
+		logger.info("Shard latency - %s", ", ".join(report))
+
+@bot.event
+async def on_shard_ready(shard_id):
+	logger.info(f"Shard {shard_id} ready")
+
+def start_loops():
+	if not routine_function.is_running():
+		routine_function.start()
+	if not catalogue_refresh.is_running():
+		catalogue_refresh.start()
+
+# Startup of the services in the background, created by the first on_ready
+services_task: Optional[asyncio.Task] = None
+
+async def prepare_services():
+	"""
+	Start the services while commands are already being served.
+	Until a service is ready its circuit is held open, so the commands using it are answered as unavailable.
+	The health monitor and the catalogue refresh start once they are up.
+	"""
+	# In a cluster the coordinator has already started the services
+	if status.get_state("service-owner"):
+		with coldstart.span("service readiness"):
+			if not await startup.ensure_all_services():
+				logger.error("Failed to ensure all services are running. Bot functionality may be limited.")
+	start_loops()
+
 @bot.event
 async def on_ready():
-	"""api_ready = await wait_for_api()
-	tools_ready = await start_tools()
-	if not api_ready:
-		logger.error("Failed to ensure API is running. Bot functionality may be limited.")
-		return"""
-	
-	all_services_running = await startup.ensure_all_services()
-	if not all_services_running:
-		logger.error("Failed to ensure all services are running. Bot functionality may be limited.")
-		return
+	global services_task
+	first_ready = services_task is None
+	if first_ready:
+		coldstart.point("gateway login")
+		services_task = asyncio.create_task(prepare_services())
 
 	logger.info(f"Bot logged in as {bot.user} (ID: {bot.user.id})")
+	gateway.report(bot)
+	if not shard_report.is_running():
+		shard_report.start()
+	# on_ready fires again after reconnects, when the commands are synced and the services monitored already
+	if not first_ready:
+		return
 
+	# The catalogue cached on disk is registered already, the catalogue refresh updates it once the API is up
 	try:
-		synced = await bot.tree.sync()
-		logger.info(f"Synced {len(synced)} command(s)")
+		if syncs_commands():
+			with coldstart.span("tree sync"):
+				synced = await commandsync.sync_tree(bot, force=status.get_state("force-sync"), guild_id=status.get_state("dev-guild-id"))
+			if synced is not None:
+				logger.info(f"Synced {len(synced)} command(s)")
+		# Only force the first sync
+		status.set_state("force-sync", False)
 	except Exception as e:
 		logger.error(f"Failed to sync commands: {e}")
 
-	routine_function.start()
-	#logger.info(f"Connected to {len(bot.guilds)} guilds")
+	await services_task
+	coldstart.report()
 
 @bot.event
 async def on_message(message):
@@ -230,33 +378,37 @@ async def on_message(message):
 	
 	await bot.process_commands(message)
 
+async def main():
+	"""Run the bot, then stop the services and close the API session on the same loop."""
+	async with bot:
+		try:
+			await bot.start(os.environ['TOKEN'])
+		finally:
+			await startup.stop_all_services()
+			await metrics.stop_server()
+
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run Roby")
+	parser.add_argument("--sync", action="store_true", help="sync the command tree even if it didn't change")
+	parser.add_argument("--guild", type=int, help="sync the commands to this guild only (instant, for development)")
+	parser.add_argument("--trace-startup", action="store_true", help="print how long each startup phase took once the bot is ready")
+	args = parser.parse_args()
+	coldstart.point("imports")
+	coldstart.enabled = args.trace_startup
+	if args.sync:
+		status.set_state("force-sync", True)
+	if args.guild:
+		status.set_state("dev-guild-id", args.guild)
+
+	worker = status.get_state("cluster-worker")
+	logs.setup(prefix=f"worker {worker} " if worker is not None else "")
 	logger.info("Starting bot...")
 	try:
-		bot.run(os.environ['TOKEN'])
+		asyncio.run(main())
 	except KeyboardInterrupt:
-		# This is caught by the signal handler
 		logger.info("Received keyboard interrupt, shutting down...")
-		pass
 	except Exception as e:
 		logger.critical(f"Failed to start bot: {e}")
 	finally:
-		# Make sure we attempt to stop services if the bot crashes
-		try:
-			# Try to get the existing event loop or create a new one
-			try:
-				loop = asyncio.get_event_loop()
-			except RuntimeError:
-				# If no event loop exists, create a new one
-				loop = asyncio.new_event_loop()
-				asyncio.set_event_loop(loop)
-			
-			# Run the cleanup function in the loop
-			if loop.is_running():
-				loop.create_task(startup.stop_all_services())
-			else:
-				loop.run_until_complete(startup.stop_all_services())
-		except Exception as e:
-			logger.error(f"Error during shutdown: {e}")
-		finally:
-			logger.info("Bot process terminated")
\ No newline at end of file
+		logger.info("Bot process terminated")
+		logs.shutdown()
@@ -0,0 +1,239 @@
+"""
+Caches for API responses: in-process for small answers, on disk for images.
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+	"""Run at most one call per key; concurrent callers for the same key share its result"""
+	def __init__(self):
+		self.calls: Dict[Hashable, asyncio.Future] = {}
+		self.shared = 0
+
+	def in_flight(self, key: Hashable) -> bool:
+		return key in self.calls
+
+	async def do(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+		"""Await the call in flight for key, or start one with fetch"""
+		future = self.calls.get(key)
+		if future is None:
+			future = asyncio.ensure_future(fetch())
+			self.calls[key] = future
+			future.add_done_callback(lambda f: self._done(key, f))
+		else:
+			self.shared += 1
+		# Shielded so a caller giving up doesn't cancel the call for everyone else
+		return await asyncio.shield(future)
+
+	def _done(self, key: Hashable, future: asyncio.Future):
+		if self.calls.get(key) is future:
+			del self.calls[key]
+		if not future.cancelled():
+			# Mark the exception as retrieved even if every caller went away
+			future.exception()
+
+class TTLCache:
+	"""
+	Cache values for ttl seconds.
+	For stale_ttl more seconds the old value is still served while a refresh runs in the background.
+	"""
+	def __init__(self, ttl: float, stale_ttl: float = 0):
+		self.ttl = ttl
+		self.stale_ttl = stale_ttl
+		self.entries: Dict[Hashable, Tuple[Any, float]] = {}
+		self.flight = SingleFlight()
+		self.refreshes = set()
+		self.hits = 0
+		self.stale_hits = 0
+		self.misses = 0
+
+	async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+		"""Return the cached value for key, fetching it if missing or expired"""
+		entry = self.entries.get(key)
+		if entry is not None:
+			value, stored_at = entry
+			age = time.monotonic() - stored_at
+			if age < self.ttl:
+				self.hits += 1
+				return value
+			if age < self.ttl + self.stale_ttl:
+				self.stale_hits += 1
+				self._revalidate(key, fetch)
+				return value
+		self.misses += 1
+		return await self.flight.do(key, lambda: self._load(key, fetch))
+
+	async def _load(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+		value = await fetch()
+		self.entries[key] = (value, time.monotonic())
+		return value
+
+	def _revalidate(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+		"""Refresh key in the background unless a refresh is already running"""
+		if self.flight.in_flight(key):
+			return
+		task = asyncio.ensure_future(self.flight.do(key, lambda: self._load(key, fetch)))
+		self.refreshes.add(task)
+		task.add_done_callback(self._refreshed)
+
+	def _refreshed(self, task: asyncio.Task):
+		self.refreshes.discard(task)
+		if not task.cancelled() and task.exception():
+			logger.warning(f"Background cache refresh failed: {task.exception()}")
+
+	def clear(self):
+		self.entries.clear()
+
+	def stats(self) -> Dict[str, Any]:
+		"""Hit/miss counters, used to tune the TTL"""
+		lookups = self.hits + self.stale_hits + self.misses
+		return {
+			"hits": self.hits,
+			"stale_hits": self.stale_hits,
+			"misses": self.misses,
+			"coalesced": self.flight.shared,
+			"hit_rate": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+			"entries": len(self.entries),
+		}
+
+class DiskLRU:
+	"""
+	Binary results (e.g. PNG images) cached on disk under content-addressed keys, with their metadata.
+	The least recently used entries are evicted once the cache grows past max_bytes.
+	"""
+	def __init__(self, path: str, max_bytes: int):
+		self.path = path
+		self.max_bytes = max_bytes
+		# key -> size in bytes, least recently used first (loaded on first use)
+		self.entries: Optional["OrderedDict[str, int]"] = None
+		self.flight = SingleFlight()
+		self.hits = 0
+		self.misses = 0
+		self.shared = 0 # lookups that joined a fetch in flight
+		self.bytes_saved = 0
+
+	def _file(self, key: str, suffix: str) -> str:
+		return os.path.join(self.path, f"{key}.{suffix}")
+
+	def _scan(self) -> "OrderedDict[str, int]":
+		os.makedirs(self.path, exist_ok=True)
+		found = []
+		for entry in os.scandir(self.path):
+			if entry.name.endswith(".bin"):
+				stat = entry.stat()
+				found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+		return OrderedDict((key, size) for _, key, size in sorted(found))
+
+	async def _index(self) -> "OrderedDict[str, int]":
+		if self.entries is None:
+			self.entries = await asyncio.to_thread(self._scan)
+		return self.entries
+
+	def _read(self, key: str) -> Tuple[bytes, Dict[str, Any]]:
+		with open(self._file(key, "bin"), "rb") as f:
+			data = f.read()
+		try:
+			with open(self._file(key, "json")) as f:
+				metadata = json.load(f)
+		except (OSError, ValueError):
+			metadata = {}
+		# Mark as recently used for the next scan
+		os.utime(self._file(key, "bin"))
+		return data, metadata
+
+	def _write(self, key: str, data: bytes, metadata: Dict[str, Any]):
+		for suffix, content, mode in (("json", json.dumps(metadata), "w"), ("bin", data, "wb")):
+			temp_path = self._file(key, f"{suffix}.{os.getpid()}.tmp")
+			with open(temp_path, mode) as f:
+				f.write(content)
+			os.replace(temp_path, self._file(key, suffix))
+
+	def _delete(self, keys: List[str]):
+		for key in keys:
+			for suffix in ("bin", "json"):
+				with contextlib.suppress(FileNotFoundError):
+					os.remove(self._file(key, suffix))
+
+	async def get(self, key: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+		"""The cached result for key, or None"""
+		entries = await self._index()
+		if key not in entries:
+			return None
+		try:
+			data, metadata = await asyncio.to_thread(self._read, key)
+		except OSError:
+			entries.pop(key, None)
+			return None
+		entries.move_to_end(key)
+		return data, metadata
+
+	async def put(self, key: str, data: bytes, metadata: Dict[str, Any]):
+		"""Store a result, evicting the least recently used ones if over the size cap"""
+		if len(data) > self.max_bytes:
+			return
+		entries = await self._index()
+		await asyncio.to_thread(self._write, key, data, metadata)
+		entries[key] = len(data)
+		entries.move_to_end(key)
+		evicted = []
+		total = sum(entries.values())
+		while total > self.max_bytes and entries:
+			old_key, size = entries.popitem(last=False)
+			evicted.append(old_key)
+			total -= size
+		if evicted:
+			await asyncio.to_thread(self._delete, evicted)
+
+	async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Tuple[bytes, Dict[str, Any]]]]) -> Tuple[bytes, Dict[str, Any], bool]:
+		"""
+		Serve key from the cache, or fetch it (once for concurrent callers) and store it.
+		Returns (data, metadata, hit): hit is True only when the result was already cached,
+		not for callers that shared a fetch in flight.
+		"""
+		cached = await self.get(key)
+		if cached is not None:
+			self.hits += 1
+			self.bytes_saved += len(cached[0])
+			return cached[0], cached[1], True
+		if self.flight.in_flight(key):
+			self.shared += 1
+		else:
+			self.misses += 1
+		data, metadata = await self.flight.do(key, lambda: self._fetch(key, fetch))
+		return data, metadata, False
+
+	async def _fetch(self, key: str, fetch: Callable[[], Awaitable[Tuple[bytes, Dict[str, Any]]]]) -> Tuple[bytes, Dict[str, Any]]:
+		data, metadata = await fetch()
+		try:
+			await self.put(key, data, metadata)
+		except OSError as e:
+			logger.warning(f"Could not cache result {key}: {e}")
+		return data, metadata
+
+	def stats(self) -> Dict[str, Any]:
+		"""Hit rate and bytes saved"""
+		lookups = self.hits + self.misses + self.shared
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"shared": self.shared,
+			"hit_rate": self.hits / lookups if lookups else 0.0,
+			"bytes_saved": self.bytes_saved,
+			"entries": len(self.entries or ()),
+			"bytes": sum((self.entries or {}).values()),
+		}
+
+def content_key(prefix: str, content) -> str:
+	"""Content-addressed cache key: prefix and the SHA-256 of the content (bytes, or JSON-serializable data)"""
+	if not isinstance(content, bytes):
+		content = json.dumps(content, sort_keys=True).encode()
+	return f"{prefix}-{hashlib.sha256(content).hexdigest()}"
@@ -1,46 +1,101 @@
-import base64
+import admission
+import asyncio
+import cache
 import discord
 from discord.ui import View
+import errors
 import functions
 import io
 import logging
+import logs
+import metrics
 import re
+import status
+import yarl
 
 logger = logging.getLogger(__name__)
 
-async def basic(endpoint, interaction):
+# Discord's limit for an embed description
+EMBED_LIMIT = 4096
+
+async def defer(interaction):
+	"""Defer the interaction to have time to elaborate the output, recording how long it took to get here"""
 	await interaction.response.defer()
+	metrics.command_deferred(interaction)
+
+async def basic(endpoint, interaction):
+	await defer(interaction)
 	response = await functions.api_POST(f"api/{endpoint}", None)
-	logger.info(f"Basic callback called with endpoint: {endpoint} - {response}")
-	await interaction.followup.send(response["result"])
+	logger.info("Basic callback called with endpoint: %s - %s", endpoint, response, extra=logs.fields(interaction, endpoint=endpoint))
+	await reply(interaction, response["result"])
 
 async def currency(endpoint, interaction):
-	await interaction.response.defer()
-	response = await functions.api_POST(f"api/{endpoint}", None)
-	logger.info(f"Currency callback called with endpoint: {endpoint} - {response}")
+	await defer(interaction)
+	response = await functions.get_quote(f"api/{endpoint}")
+	logger.info("Currency callback called with endpoint: %s - %s", endpoint, response, extra=logs.fields(interaction, endpoint=endpoint))
+	await reply(interaction, format_usd(response["result"]))
+
+async def reply(interaction, content=None, *, file=None, **kwargs):
+	"""
+	Send the answer as a followup and return its message.
+	If the original response shows the queue status, the answer replaces it instead of leaving it behind.
+	"""
+	if admission.take_status(interaction):
+		return await interaction.edit_original_response(content=content, attachments=[file] if file else [], **kwargs)
+	if content is not None:
+		kwargs["content"] = content
+	if file is not None:
+		kwargs["file"] = file
+	return await interaction.followup.send(wait=True, **kwargs)
+
+def format_usd(result):
 	# Format the number with thousands separator
-	value = float(response["result"])
+	value = float(result)
 	# Remove trailing zeros from decimal places
 	if value.is_integer():
-		parsed_response = f"{value:,.0f} USD"
+		return f"{value:,.0f} USD"
+	# Remove trailing zeros but keep necessary decimals
+	return f"{value:,.{len(str(value).split('.')[-1].rstrip('0'))}f} USD"
+
+async def render(endpoint, interaction, renderer, params=None):
+	"""
+	Generic callback for commands generated from the endpoint catalogue.
+	renderer is how the answer is shown: text, currency, image or embed.
+	"""
+	await defer(interaction)
+	if renderer == "image":
+		image_data, metadata = await functions.api_POST_image(endpoint, params)
+		logger.info("Render callback called with endpoint: %s - %s", endpoint, metadata, extra=logs.fields(interaction, endpoint=endpoint, payload_size=len(image_data)))
+		file = discord.File(io.BytesIO(image_data), filename="image.png")
+		embed = discord.Embed()
+		embed.set_image(url="attachment://image.png")
+		if "generation_time" in metadata:
+			embed.set_footer(text=f"⌛ Generated on a MacMini in {int(float(metadata['generation_time']))} seconds")
+		return await reply(interaction, embed=embed, file=file)
+
+	response = await functions.api_POST(endpoint, params)
+	logger.info("Render callback called with endpoint: %s - %s", endpoint, response, extra=logs.fields(interaction, endpoint=endpoint))
+	if renderer == "currency":
+		await reply(interaction, format_usd(response["result"]))
+	elif renderer == "embed":
+		pages = split_text(str(response["result"]), EMBED_LIMIT) or ["…"]
+		await reply(interaction, embeds=[discord.Embed(description=page, color=0xAEF39B) for page in pages[:10]])
 	else:
-		# Remove trailing zeros but keep necessary decimals
-		parsed_response = f"{value:,.{len(str(value).split('.')[-1].rstrip('0'))}f} USD"
-	await interaction.followup.send(parsed_response)
+		await reply(interaction, str(response["result"])[:2000])
 
 async def haiku(interaction, about):
-	await interaction.response.defer()
+	await defer(interaction)
 	# Get the 'about' parameter from the interaction options
 	if about:
 		response = await functions.api_POST('api/haiku', {"about": about})
 	else:
 		response = await functions.api_POST('api/haiku', None)
-	await interaction.followup.send(response["result"])
+	await reply(interaction, response["result"])
 
 async def joke(interaction):
-    await interaction.response.defer()
+    await defer(interaction)
     response = await functions.api_POST('api/joke', None)
-    logger.info(f"Joke callback called - {response}")
+    logger.info("Joke callback called - %s", response, extra=logs.fields(interaction, endpoint="api/joke"))
     
     label = response['result']['question']
     callback_message = response['result']['answer']
@@ -54,56 +109,210 @@ async def joke(interaction):
             await button_interaction.response.send_message(callback_message)
             
     # Send a message with the view (include some content to avoid the empty message error)
-    await interaction.followup.send(content="Here's a joke for you:", view=CustomView())
+    await reply(interaction, "Here's a joke for you:", view=CustomView())
 
-async def image(interaction, prompt):
-	await interaction.response.defer()
-	response = await functions.api_POST('api/image', {"prompt": prompt})
-	b64_image = response['result']['b64']
-	generation_time = response['result']['generation_time']
-	total_energy_nespresso = response['result']['total_energy_nespresso']
-	image_data = base64.b64decode(b64_image)
-	logger.info(f"Image callback called - {response}")
+async def image(interaction, prompt, seed=None):
+	await defer(interaction)
+	payload = {"prompt": prompt}
+	if seed is not None:
+		payload["seed"] = seed
+	job_id = None
+	from_cache = False
+
+	async def generate():
+		nonlocal job_id
+		job_id = await functions.submit_job('api/image', payload)
+		if job_id is None:
+			return await functions.api_POST_image('api/image', payload)
+		async def progress(job):
+			await interaction.edit_original_response(content=describe_job(job))
+		return await functions.wait_for_job('api/image', job_id, progress)
+
+	# Only a fixed seed makes the same prompt give the same image
+	if seed is not None and status.get_state("result-cache-enabled"):
+		key = cache.content_key("image", functions.normalize_payload(payload))
+		image_data, metadata, from_cache = await functions.result_cache.get_or_fetch(key, generate)
+	else:
+		image_data, metadata = await generate()
+	logger.info("Image callback called - %s", metadata, extra=logs.fields(interaction, endpoint="api/image", payload_size=len(image_data)))
+	generation_time = float(metadata['generation_time'])
+	total_energy_nespresso = metadata['total_energy_nespresso']
 	file = discord.File(io.BytesIO(image_data), filename="image.png")
 	embed = discord.Embed()
 	embed.set_image(url="attachment://image.png")
-	embed.set_footer(text=f"✏️ prompt: {prompt}\n⌛ Generated on a MacMini in {int(generation_time)} seconds\n☕️ This generation used the energy of {total_energy_nespresso} espresso")
-	await interaction.followup.send(embed=embed, file=file)
+	footer = f"✏️ prompt: {prompt}\n⌛ Generated on a MacMini in {int(generation_time)} seconds\n☕️ This generation used the energy of {total_energy_nespresso} espresso"
+	if from_cache:
+		footer += "\n♻️ Served from cache, no energy used this time"
+	embed.set_footer(text=footer)
+	if job_id is None:
+		await reply(interaction, embed=embed, file=file)
+	else:
+		# Replace the progress message with the image
+		await interaction.edit_original_response(content=None, embed=embed, attachments=[file])
+
+def describe_job(job):
+	"""Progress text for a queued or running generation job"""
+	eta = f", ETA ~{int(job['eta'])}s" if job.get("eta") is not None else ""
+	if job.get("status") == "queued":
+		return f"⏳ Waiting in queue (position {job.get('position', '?')}){eta}"
+	progress = f" {int(float(job['progress']) * 100)}%" if job.get("progress") is not None else ""
+	return f"🎨 Generating{progress}{eta}"
 
 async def rembg(interaction, image_url=None, attachment=None):
-	await interaction.response.defer()
+	await defer(interaction)
+	# If neither an attachment nor a url is given, check message attachments (for context menu commands)
+	if not attachment and not image_url and hasattr(interaction, 'message') and interaction.message and interaction.message.attachments:
+		attachment = interaction.message.attachments[0]
 	if attachment:
 		image_url = attachment.url
-	# If no attachment but image_url is provided, use that
-	elif image_url:
-		pass
-	# If neither, check message attachments (for context menu commands)
-	elif hasattr(interaction, 'message') and interaction.message and interaction.message.attachments:
-		image_url = interaction.message.attachments[0].url
-	else:
+	elif not image_url:
 		return await interaction.followup.send("Please provide an image or attach one to your message.")
 	
-	response = await functions.api_POST('api/rembg', {"image_url": image_url})
 	try:
-		image_data = base64.b64decode(response["result"])
+		source = await source_image(image_url, attachment)
+	except errors.InvalidInputError as e:
+		return await interaction.followup.send(f"🖼️ {e}")
+
+	async def fetch():
+		if source is not None and status.get_state("rembg-upload"):
+			data, content_type = source
+			result = await functions.api_POST_upload('api/rembg', data, f"image.{content_type.split('/')[-1]}", content_type)
+			if result is not None:
+				return result
+		return await functions.api_POST_image('api/rembg', {"image_url": image_url})
+
+	try:
+		if source is not None and status.get_state("result-cache-enabled"):
+			# Keyed on the image itself, so re-runs hit the cache whatever the url
+			image_data, metadata, _ = await functions.result_cache.get_or_fetch(cache.content_key("rembg", source[0]), fetch)
+		else:
+			image_data, metadata = await fetch()
 		file = discord.File(io.BytesIO(image_data), filename="no_bg.png")
-		await interaction.followup.send("", file=file)
+		await reply(interaction, file=file)
+	except Exception as e:
+		logger.error("Error removing background - %s", e, extra=logs.fields(interaction, endpoint="api/rembg"))
+		return await reply(interaction, f'Error removing background - {e}')
+	logger.info("Remove background callback called", extra=logs.fields(interaction, endpoint="api/rembg", payload_size=len(image_data)))
+
+IMAGE_SIGNATURES = (
+	(b"\x89PNG\r\n\x1a\n", "image/png"),
+	(b"\xff\xd8\xff", "image/jpeg"),
+	(b"GIF87a", "image/gif"),
+	(b"GIF89a", "image/gif"),
+)
+
+def image_format(data):
+	"""Content type of an image from its first bytes, or None if it isn't a known image format"""
+	if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+		return "image/webp"
+	for signature, content_type in IMAGE_SIGNATURES:
+		if data.startswith(signature):
+			return content_type
+	return None
+
+async def source_image(image_url, attachment=None):
+	"""
+	Read the image to process as (bytes, content type), checking its size and format.
+	Attachments larger than rembg-max-dimension are downscaled by Discord's media proxy.
+	Raises errors.InvalidInputError for images that must not reach the tool.
+	Returns None if the bytes aren't needed or can't be downloaded (the tool then fetches the url itself).
+	"""
+	if not status.get_state("rembg-upload") and not status.get_state("result-cache-enabled"):
+		return None
+	max_bytes = status.get_state("rembg-max-bytes")
+	formats = status.get_state("rembg-formats")
+	max_dimension = status.get_state("rembg-max-dimension")
+	too_large = f"This image is too large, the limit is {max_bytes // 2**20} MB."
+	unsupported = f"Unsupported image format, please use {', '.join(f.split('/')[-1].upper() for f in formats)}."
+	try:
+		if attachment:
+			if attachment.content_type and attachment.content_type.split(";")[0] not in formats:
+				raise errors.InvalidInputError(unsupported)
+			if attachment.width and attachment.height and max(attachment.width, attachment.height) > max_dimension:
+				scale = max_dimension / max(attachment.width, attachment.height)
+				url = yarl.URL(attachment.proxy_url).update_query(width=int(attachment.width * scale), height=int(attachment.height * scale))
+				data = await functions.fetch_url(str(url), max_bytes)
+			elif attachment.size > max_bytes:
+				raise errors.InvalidInputError(too_large)
+			else:
+				data = await attachment.read()
+		else:
+			data = await functions.fetch_url(image_url, max_bytes)
+	except errors.InvalidInputError:
+		raise
 	except Exception as e:
-		logger.error(f"Error removing background - {e}")
-		await interaction.followup.send(f'Error removing background - {e}')
-	logger.info(f"Remove background callback called - {response}")
+		logger.warning("Could not read source image %s: %s", image_url, e)
+		return None
+	if data is None:
+		raise errors.InvalidInputError(too_large)
+	content_type = image_format(data)
+	if content_type not in formats:
+		raise errors.InvalidInputError(unsupported)
+	return data, content_type
 
 async def roby(interaction, prompt):
-	await interaction.response.defer()
-	response = await functions.api_POST('api/roby', {"prompt": prompt})
-	logger.info(f"Roby callback called - {response}")
-	embed = discord.Embed(description=response["result"])
-	embed.set_author(name=f"💬 {prompt[:250] + ('…' if len(prompt) > 250 else '')}", icon_url=interaction.user.avatar.url)
+	await defer(interaction)
+	author = f"💬 {prompt[:250] + ('…' if len(prompt) > 250 else '')}"
+	if not status.get_state("roby-streaming"):
+		response = await functions.api_POST('api/roby', {"prompt": prompt})
+		logger.info("Roby callback called - %s", response, extra=logs.fields(interaction, endpoint="api/roby"))
+		await send_pages(interaction, [], split_text(response["result"], EMBED_LIMIT) or ["…"], author)
+		return
+
+	interval = status.get_state("stream-edit-interval")
+	loop = asyncio.get_running_loop()
+	messages = []
+	text = ""
+	last_edit = 0
+	async for chunk in functions.api_POST_stream('api/roby', {"prompt": prompt, "stream": True}):
+		text += chunk
+		if text.strip() and loop.time() - last_edit >= interval:
+			await send_pages(interaction, messages, split_text(text, EMBED_LIMIT), author)
+			last_edit = loop.time()
+	logger.info("Roby callback called - streamed", extra=logs.fields(interaction, endpoint="api/roby", payload_size=len(text)))
+	await send_pages(interaction, messages, split_text(text, EMBED_LIMIT) or ["…"], author)
+
+def roby_embed(page, author=None, icon_url=None):
+	embed = discord.Embed(description=page)
+	if author:
+		embed.set_author(name=author, icon_url=icon_url)
 	embed.color = 0xAEF39B
-	await interaction.followup.send(embed=embed)
+	return embed
+
+async def send_pages(interaction, messages, pages, author):
+	"""
+	Show pages of text as embeds, one followup message per page.
+	messages holds (message, page) for the pages already sent: changed pages are edited, new ones are sent.
+	"""
+	for index, page in enumerate(pages):
+		embed = roby_embed(page, author if index == 0 else None, interaction.user.display_avatar.url)
+		if index < len(messages):
+			message, shown = messages[index]
+			if shown != page:
+				await message.edit(embed=embed)
+				messages[index] = (message, page)
+		else:
+			message = await reply(interaction, embed=embed)
+			messages.append((message, page))
+
+def split_text(text, limit):
+	"""
+	Split text into pages of at most limit characters, breaking on whitespace where possible.
+	Earlier pages don't change as more text is appended.
+	"""
+	pages = []
+	while len(text) > limit:
+		cut = max(text.rfind("\n", 0, limit + 1), text.rfind(" ", 0, limit + 1))
+		if cut <= 0:
+			cut = limit
+		pages.append(text[:cut])
+		text = text[cut:].lstrip()
+	if text.strip():
+		pages.append(text)
+	return pages
 
 async def throw(interaction, faces):
-	await interaction.response.defer()
+	await defer(interaction)
 	response = await functions.api_POST('api/throw', {"faces": faces})
-	logger.info(f"Throw callback called with faces: {faces} - {response}")
-	await interaction.followup.send(response["result"])
\ No newline at end of file
+	logger.info("Throw callback called with faces: %s - %s", faces, response, extra=logs.fields(interaction, endpoint="api/throw"))
+	await reply(interaction, response["result"])
\ No newline at end of file
@@ -0,0 +1,203 @@
+"""
+Slash commands generated from the API's endpoint catalogue.
+
+The catalogue (GET endpoints) lists the API routes. Each entry is either a route string or a dict like
+	{"name": "wisdom", "route": "api/wisdom", "description": "🧙 Ask roby for wisdom",
+	 "params": [{"name": "about", "type": "string", "description": "The topic", "required": true}],
+	 "renderer": "text"}
+Routes that already have a hand-written command in bot.py keep it.
+The last catalogue is cached on disk so cold boots can register the commands before the API is up.
+"""
+import callbacks
+import discord
+from discord import app_commands
+import functions
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+import status
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('discord')
+
+PARAM_TYPES = {
+	"string": str,
+	"str": str,
+	"integer": int,
+	"int": int,
+	"number": float,
+	"float": float,
+	"boolean": bool,
+	"bool": bool,
+}
+RENDERERS = ("text", "currency", "image", "embed")
+NAME_PATTERN = re.compile(r"^[-_a-z0-9]{1,32}$")
+EMBED_MAX_FIELDS = 25
+
+# Generated commands, by name, with the entry they were built from
+registered: Dict[str, dict] = {}
+
+# Fingerprint of the catalogue the registered commands come from
+current_fingerprint: Optional[str] = None
+
+# /help embed, rebuilt only when the commands change
+help_cache: Optional[discord.Embed] = None
+
+def normalize_entry(entry) -> Optional[dict]:
+	"""Turn a catalogue entry into a full entry dict, or None if it can't be used"""
+	if isinstance(entry, str):
+		entry = {"route": entry}
+	if not isinstance(entry, dict):
+		return None
+	route = (entry.get("route") or entry.get("path") or entry.get("endpoint") or "").strip("/")
+	name = entry.get("name")
+	if name is None:
+		# Only top-level API routes (api/<name>) become commands on their own:
+		# nested ones (api/rembg/upload, api/image/jobs) belong to another command,
+		# and the others (endpoints, docs) aren't commands at all
+		segments = route.split("/")
+		if len(segments) != 2 or segments[0] != "api":
+			return None
+		name = segments[1]
+	name = name.lower()
+	if not route or not NAME_PATTERN.match(name):
+		return None
+	params = []
+	for param in entry.get("params") or []:
+		if param.get("type", "string") not in PARAM_TYPES or not NAME_PATTERN.match(param.get("name", "")):
+			logger.warning(f"Skipping endpoint {name}: unsupported parameter {param}")
+			return None
+		params.append({
+			"name": param["name"],
+			"type": param.get("type", "string"),
+			"description": (param.get("description") or param["name"])[:100],
+			"required": param.get("required", True),
+		})
+	renderer = entry.get("renderer", "text")
+	return {
+		"name": name,
+		"route": route,
+		"description": (entry.get("description") or f"/{name}")[:100],
+		"params": params,
+		"renderer": renderer if renderer in RENDERERS else "text",
+	}
+
+def parse(catalogue) -> List[dict]:
+	"""Usable entries of a catalogue, as returned by the API"""
+	if isinstance(catalogue, dict):
+		catalogue = catalogue.get("endpoints") or catalogue.get("result") or []
+	entries = (normalize_entry(entry) for entry in catalogue)
+	return [entry for entry in entries if entry is not None]
+
+def fingerprint(catalogue) -> str:
+	return hashlib.sha256(json.dumps(catalogue, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_cached():
+	"""The catalogue cached on disk, or None"""
+	try:
+		with open(status.get_state("catalogue-path")) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return None
+	except (OSError, ValueError) as e:
+		logger.warning(f"Could not read the cached endpoint catalogue: {e}")
+		return None
+
+def save_cached(catalogue):
+	path = status.get_state("catalogue-path")
+	temp_path = f"{path}.{os.getpid()}.tmp"
+	with open(temp_path, "w") as f:
+		json.dump(catalogue, f, indent=1)
+	os.replace(temp_path, path)
+
+def build_command(entry: dict) -> app_commands.Command:
+	"""Build a slash command with typed parameters that renders the endpoint's answer"""
+	async def callback(interaction: discord.Interaction, **params):
+		logger.info(f"{entry['name'].capitalize()} command called")
+		payload = {key: value for key, value in params.items() if value is not None} or None
+		await callbacks.render(entry["route"], interaction, entry["renderer"], payload)
+
+	parameters = [inspect.Parameter("interaction", inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=discord.Interaction)]
+	# Discord wants required parameters first
+	for param in sorted(entry["params"], key=lambda param: not param["required"]):
+		annotation = PARAM_TYPES[param["type"]]
+		if param["required"]:
+			parameters.append(inspect.Parameter(param["name"], inspect.Parameter.KEYWORD_ONLY, annotation=annotation))
+		else:
+			parameters.append(inspect.Parameter(param["name"], inspect.Parameter.KEYWORD_ONLY, annotation=Optional[annotation], default=None))
+	callback.__signature__ = inspect.Signature(parameters)
+	if entry["params"]:
+		app_commands.describe(**{param["name"]: param["description"] for param in entry["params"]})(callback)
+	return app_commands.Command(name=entry["name"], description=entry["description"], callback=callback)
+
+def apply(tree: app_commands.CommandTree, catalogue) -> bool:
+	"""
+	Register the catalogue's commands, updating only those that were added, changed or removed.
+	Returns whether the command tree changed.
+	"""
+	global current_fingerprint, help_cache
+	current_fingerprint = fingerprint(catalogue)
+	entries = {entry["name"]: entry for entry in parse(catalogue)}
+	changed = False
+	for name in list(registered):
+		if registered[name] != entries.get(name):
+			tree.remove_command(name)
+			del registered[name]
+			changed = True
+	for name, entry in entries.items():
+		if name in registered:
+			continue
+		if tree.get_command(name) is not None:
+			# Hand-written command
+			continue
+		try:
+			tree.add_command(build_command(entry))
+		except (app_commands.AppCommandError, TypeError, ValueError) as e:
+			logger.warning(f"Could not register /{name}: {e}")
+			continue
+		registered[name] = entry
+		changed = True
+	if changed:
+		help_cache = None
+		logger.info(f"Registered {len(registered)} command(s) from the endpoint catalogue")
+	return changed
+
+def load(tree: app_commands.CommandTree) -> bool:
+	"""Register the commands from the catalogue cached on disk, for fast cold boots"""
+	catalogue = load_cached()
+	if catalogue is None:
+		return False
+	return apply(tree, catalogue)
+
+async def refresh(tree: app_commands.CommandTree) -> bool:
+	"""
+	Fetch the catalogue from the API and apply it if it changed.
+	Returns whether the command tree changed.
+	"""
+	catalogue = await functions.get_endpoints()
+	if fingerprint(catalogue) == current_fingerprint:
+		return False
+	try:
+		save_cached(catalogue)
+	except OSError as e:
+		logger.warning(f"Could not cache the endpoint catalogue: {e}")
+	return apply(tree, catalogue)
+
+def help_embed(tree: app_commands.CommandTree) -> discord.Embed:
+	"""Embed listing all commands, cached until the commands change"""
+	global help_cache
+	if help_cache is None:
+		embed = discord.Embed(title="Available Commands", color=0x00ff00)
+		commands = sorted(tree.get_commands(), key=lambda x: x.name)
+		for cmd in commands:
+			desc = cmd.description if cmd.description else "No description available"
+			if len(commands) <= EMBED_MAX_FIELDS:
+				embed.add_field(name=f"/{cmd.name}", value=desc, inline=False)
+			else:
+				# Too many commands for one field each
+				embed.description = (embed.description or "") + f"**/{cmd.name}** {desc}\n"
+		help_cache = embed
+	return help_cache
@@ -0,0 +1,181 @@
+"""
+Cluster launcher: run the bot's shards across several worker processes.
+
+The coordinator (this script) owns the services: it starts them, restarts them when they die and stops them on exit.
+Each worker is a bot.py process running an AutoShardedBot over a range of shards, configured through the
+ROBY_CLUSTER_STATE environment variable, and leaves the services alone.
+
+	uv run cluster.py --workers 4
+"""
+import aiohttp
+import argparse
+import asyncio
+import cache
+import functions
+import health
+import json
+import logging
+import logs
+import metrics
+import os
+import signal
+import startup
+import status
+import sys
+from typing import List, Optional
+
+logger = logging.getLogger('discord')
+
+STATE_VARIABLE = "ROBY_CLUSTER_STATE"
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+# Limits the workers split between them, so the cluster puts the same load on the services as a single bot
+# (except for service-concurrency limits below the number of workers, see oversubscribed)
+SPLIT_LIMITS = ("API-pool-size", "API-pool-size-per-host", "queue-limit")
+
+def join():
+	"""In a worker, take the state the coordinator passed on"""
+	shared = os.environ.get(STATE_VARIABLE)
+	if shared:
+		for key, value in json.loads(shared).items():
+			status.set_state(key, value)
+		# Created when functions was imported, before the worker's own directory and share were known
+		functions.result_cache = cache.DiskLRU(status.get_state("result-cache-path"), status.get_state("result-cache-max-bytes"))
+
+def shard_ranges(shard_count: int, workers: int) -> List[List[int]]:
+	"""Split the shard ids into contiguous ranges, one per worker, as even as possible"""
+	workers = max(1, min(workers, shard_count))
+	size, extra = divmod(shard_count, workers)
+	ranges = []
+	start = 0
+	for index in range(workers):
+		end = start + size + (1 if index < extra else 0)
+		ranges.append(list(range(start, end)))
+		start = end
+	return ranges
+
+def worker_state(index: int, shard_ids: List[int], shard_count: int, workers: int) -> dict:
+	"""The coordinator's state, adjusted for one of its workers"""
+	state = dict(status.state)
+	for key in SPLIT_LIMITS:
+		state[key] = max(1, state[key] // workers)
+	state["service-concurrency"] = {service: max(1, limit // workers) for service, limit in state["service-concurrency"].items()}
+	# Each worker indexes only the results it wrote, so it gets its own directory and share of the size cap
+	state["result-cache-path"] = os.path.join(state["result-cache-path"], f"worker-{index}")
+	state["result-cache-max-bytes"] = state["result-cache-max-bytes"] // workers
+	state.update({
+		"sharded": True,
+		"shard-count": shard_count,
+		"shard-ids": shard_ids,
+		"cluster-worker": index,
+		"service-owner": False,
+	})
+	if state["metrics-port"]:
+		# The coordinator serves on metrics-port, the workers on the ports after it
+		state["metrics-port"] += 1 + index
+	return state
+
+def oversubscribed(workers: int) -> List[str]:
+	"""Services whose concurrency limit is below the number of workers, which each still get one slot"""
+	return [service for service, limit in status.get_state("service-concurrency").items() if limit < workers]
+
+async def recommended_shards(token: str) -> int:
+	"""Number of shards Discord recommends for this bot"""
+	session = await functions.get_session()
+	async with session.get(GATEWAY_URL, headers={"Authorization": f"Bot {token}"}, timeout=aiohttp.ClientTimeout(total=10)) as response:
+		response.raise_for_status()
+		return (await response.json())["shards"]
+
+async def run_worker(index: int, state: dict) -> asyncio.subprocess.Process:
+	env = dict(os.environ, **{STATE_VARIABLE: json.dumps(state)})
+	# Own session, so a Ctrl+C in the terminal reaches the coordinator only and the workers are stopped in order
+	process = await asyncio.create_subprocess_exec(sys.executable, BOT_PATH, env=env, start_new_session=True)
+	logger.info(f"Started worker {index} (PID: {process.pid}) with shards {state['shard-ids']}")
+	return process
+
+async def supervise(index: int, state: dict, processes: dict, stopping: asyncio.Event):
+	"""Keep a worker running, restarting it with backoff when it exits"""
+	delays = startup.backoff_delays(status.get_state("restart-initial-delay"), status.get_state("restart-max-delay"))
+	while not stopping.is_set():
+		processes[index] = await run_worker(index, state)
+		code = await processes[index].wait()
+		if stopping.is_set():
+			return
+		delay = next(delays)
+		logger.warning(f"Worker {index} exited with code {code}, restarting in {delay:.1f}s")
+		try:
+			await asyncio.wait_for(stopping.wait(), delay)
+		except asyncio.TimeoutError:
+			pass
+
+async def stop_workers(processes: dict):
+	"""Ask the workers to shut down, killing the ones that don't within STOP_TIMEOUT"""
+	running = [process for process in processes.values() if process.returncode is None]
+	for process in running:
+		process.send_signal(signal.SIGINT)
+	for process in running:
+		try:
+			await asyncio.wait_for(process.wait(), startup.STOP_TIMEOUT)
+		except asyncio.TimeoutError:
+			logger.warning(f"Worker {process.pid} didn't stop, forcing kill")
+			process.kill()
+			await process.wait()
+
+async def monitor(stopping: asyncio.Event):
+	"""Health checks and restarts of the services, on behalf of the whole cluster"""
+	while not stopping.is_set():
+		await health.check_services(startup.services, await functions.get_session())
+		try:
+			await asyncio.wait_for(stopping.wait(), status.get_state("health-interval"))
+		except asyncio.TimeoutError:
+			pass
+
+async def main(workers: int, shard_count: Optional[int]):
+	"""Start the services and the workers, and stop them all on SIGINT or SIGTERM"""
+	stopping = asyncio.Event()
+	loop = asyncio.get_running_loop()
+	for signum in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(signum, stopping.set)
+
+	processes = {}
+	await functions.open_session()
+	await metrics.start_server()
+	try:
+		if not await startup.ensure_all_services():
+			logger.error("Failed to ensure all services are running. Bot functionality may be limited.")
+		shard_count = shard_count or await recommended_shards(os.environ['TOKEN'])
+		ranges = shard_ranges(shard_count, workers)
+		logger.info(f"Running {shard_count} shard(s) on {len(ranges)} worker(s)")
+		for service in oversubscribed(len(ranges)):
+			logger.warning(f"{service} allows {status.get_state('service-concurrency')[service]} call(s) at once, "
+				f"but each of the {len(ranges)} workers gets a slot: the cluster may run {len(ranges)} at once")
+		tasks = [asyncio.create_task(supervise(index, worker_state(index, shard_ids, shard_count, len(ranges)), processes, stopping)) for index, shard_ids in enumerate(ranges)]
+		tasks.append(asyncio.create_task(monitor(stopping)))
+		await stopping.wait()
+		logger.info("Stopping the cluster...")
+		await stop_workers(processes)
+		await asyncio.gather(*tasks, return_exceptions=True)
+	finally:
+		await stop_workers(processes)
+		await startup.stop_all_services()
+		await metrics.stop_server()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run Roby's shards across several processes")
+	parser.add_argument("--workers", type=int, default=status.get_state("cluster-workers"), help="number of worker processes")
+	parser.add_argument("--shards", type=int, default=status.get_state("shard-count"), help="total number of shards (default: Discord's recommendation)")
+	parser.add_argument("--sync", action="store_true", help="sync the command tree even if it didn't change")
+	parser.add_argument("--guild", type=int, help="sync the commands to this guild only (instant, for development)")
+	args = parser.parse_args()
+	if args.sync:
+		status.set_state("force-sync", True)
+	if args.guild:
+		status.set_state("dev-guild-id", args.guild)
+
+	logs.setup(prefix="coordinator ")
+	try:
+		asyncio.run(main(args.workers, args.shards))
+	except Exception as e:
+		logger.critical(f"Cluster failed: {e}")
+	finally:
+		logs.shutdown()
@@ -0,0 +1,55 @@
+"""
+Startup tracer: how long each phase of a cold start takes, from the first import to serving commands.
+
+bot.py imports this module first, so the clock starts before the other imports.
+Phases are recorded as spans, which may overlap (the services start while commands are already served).
+"""
+import contextlib
+import sys
+import time
+from typing import List, Tuple
+
+started_at = time.perf_counter()
+enabled = False # print the breakdown once the bot is ready (bot.py --trace-startup)
+
+# (phase, start, end) in seconds since started_at
+spans: List[Tuple[str, float, float]] = []
+
+def now() -> float:
+	return time.perf_counter() - started_at
+
+def record(phase: str, start: float, end: float):
+	spans.append((phase, start, end))
+	# Imported here: metrics pulls in aiohttp, which the imports phase is timing
+	import metrics
+	metrics.startup_seconds.set(phase, value=end - start)
+
+def point(phase: str):
+	"""Record a phase that started when the previous one ended"""
+	record(phase, spans[-1][2] if spans else 0.0, now())
+
+@contextlib.contextmanager
+def span(phase: str):
+	"""Record the time spent in the block as a phase"""
+	start = now()
+	try:
+		yield
+	finally:
+		record(phase, start, now())
+
+def breakdown(width: int = 40) -> str:
+	"""The phases as a table, with a bar showing when each one ran"""
+	total = max(end for _, _, end in spans)
+	name_width = max(len(phase) for phase, _, _ in spans)
+	lines = [f"Cold start: {total * 1000:.0f} ms"]
+	for phase, start, end in spans:
+		offset = int(start / total * width)
+		length = max(1, int((end - start) / total * width))
+		bar = " " * offset + "█" * length
+		lines.append(f"  {phase:<{name_width}}  {start * 1000:>7.0f} ms +{(end - start) * 1000:>7.0f} ms  |{bar:<{width}}|")
+	return "\n".join(lines)
+
+def report():
+	"""Print the breakdown, if tracing is enabled"""
+	if enabled and spans:
+		print(breakdown(), file=sys.stderr, flush=True)
@@ -0,0 +1,67 @@
+"""
+Sync the slash command tree with Discord only when it changed.
+The fingerprint of the last synced tree is kept on disk, so restarts and reconnects skip the rate-limited sync endpoint.
+"""
+import discord
+import hashlib
+import json
+import logging
+import os
+import status
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('discord')
+
+def command_payload(command, tree) -> dict:
+	"""The payload Discord receives for a command (names, descriptions, parameters)"""
+	try:
+		return command.to_dict(tree)
+	except TypeError:
+		# discord.py < 2.4 doesn't take the tree
+		return command.to_dict()
+
+def tree_fingerprint(tree, guild: Optional[discord.abc.Snowflake] = None) -> str:
+	"""Stable hash of the commands registered for a guild, or the global ones"""
+	payloads = sorted((command_payload(command, tree) for command in tree.get_commands(guild=guild)), key=lambda payload: (payload.get("type", 1), payload["name"]))
+	return hashlib.sha256(json.dumps(payloads, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_fingerprints() -> Dict[str, str]:
+	path = status.get_state("tree-fingerprint-path")
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return {}
+	except (OSError, ValueError) as e:
+		logger.warning(f"Could not read the command tree fingerprints: {e}")
+		return {}
+
+def save_fingerprints(fingerprints: Dict[str, str]):
+	path = status.get_state("tree-fingerprint-path")
+	temp_path = f"{path}.tmp"
+	with open(temp_path, "w") as f:
+		json.dump(fingerprints, f, indent=1, sort_keys=True)
+	os.replace(temp_path, path)
+
+async def sync_tree(bot, force: bool = False, guild_id: Optional[int] = None) -> Optional[List[discord.app_commands.AppCommand]]:
+	"""
+	Sync the command tree if it changed since the last sync, or if force is set.
+	With guild_id the global commands are copied to that guild and synced there only, which is instant (for development).
+	Returns the synced commands, or None if the sync was skipped.
+	"""
+	guild = discord.Object(id=guild_id) if guild_id else None
+	if guild is not None:
+		bot.tree.copy_global_to(guild=guild)
+	fingerprint = tree_fingerprint(bot.tree, guild)
+	scope = f"{bot.application_id}:{guild_id or 'global'}"
+	fingerprints = load_fingerprints()
+	if not force and fingerprints.get(scope) == fingerprint:
+		logger.info(f"Command tree unchanged ({scope}), skipping sync")
+		return None
+	synced = await bot.tree.sync(guild=guild)
+	fingerprints[scope] = fingerprint
+	try:
+		save_fingerprints(fingerprints)
+	except OSError as e:
+		logger.warning(f"Could not save the command tree fingerprint: {e}")
+	return synced
@@ -0,0 +1,51 @@
+"""
+Errors raised by the bot when talking to the Domestic AI services.
+Callbacks let them propagate; the slash command error handler turns them into short messages for the user.
+"""
+
+class APIError(Exception):
+	"""Raised when a call to the Domestic API fails"""
+	def __init__(self, endpoint: str, message: str):
+		self.endpoint = endpoint
+		super().__init__(message)
+
+class APITimeoutError(APIError):
+	"""Raised when the API doesn't answer in time"""
+	def __init__(self, endpoint: str):
+		super().__init__(endpoint, f"{endpoint} timed out")
+
+class APIConnectionError(APIError):
+	"""Raised when the API can't be reached"""
+	def __init__(self, endpoint: str, reason: str):
+		super().__init__(endpoint, f"{endpoint} could not be reached: {reason}")
+
+class APIStatusError(APIError):
+	"""Raised when the API answers with an error status"""
+	def __init__(self, endpoint: str, status: int, detail: str = ""):
+		self.status = status
+		self.detail = detail
+		super().__init__(endpoint, f"{endpoint} answered {status}" + (f": {detail}" if detail else ""))
+
+class APIResponseError(APIError):
+	"""Raised when the API answers with a body the bot can't read"""
+
+class ServiceUnavailableError(APIError):
+	"""Raised when a call is refused because its backend service is down"""
+	def __init__(self, service: str, endpoint: str = ""):
+		self.service = service
+		super().__init__(endpoint, f"{service} is unavailable")
+
+class InvalidInputError(Exception):
+	"""Raised when a user's input is rejected before reaching the services (e.g. an oversized image)"""
+
+class AdmissionError(Exception):
+	"""Raised when a call is turned away by admission control; the message is shown to the user"""
+
+class RateLimitedError(AdmissionError):
+	"""Raised when a user or guild sends calls faster than its rate limit"""
+	def __init__(self, retry_after: float):
+		self.retry_after = retry_after
+		super().__init__(f"🐢 Slow down! Try again in {max(1, round(retry_after))} seconds.")
+
+class QueueFullError(AdmissionError):
+	"""Raised when too many calls are already waiting for a service"""
@@ -1,27 +1,450 @@
+import admission
 import aiohttp
+import asyncio
+import base64
+import cache
+import codecs
+import contextlib
+import errors
+import hashlib
+import health
+import json
 import logging
+import metrics
+import pregen
+import re
+import retry
 import status
+import time
+import warmup
+from typing import Dict, Optional
 api_url = status.get_state("API-url")
 logger = logging.getLogger(__name__)
+
+# Shared API session, opened in the bot's setup hook and closed on shutdown
+session: Optional[aiohttp.ClientSession] = None
+
+# Currency quotes, keyed by endpoint
+quote_cache = cache.TTLCache(ttl=status.get_state("quote-ttl"), stale_ttl=status.get_state("quote-stale-ttl"))
+
+# Identical in-flight generation calls, keyed by endpoint and normalized payload
+generation_flight = cache.SingleFlight()
+
+# Images from /image and /rembg, keyed by content
+result_cache = cache.DiskLRU(status.get_state("result-cache-path"), status.get_state("result-cache-max-bytes"))
+
+# Retries left for idempotent calls, shared by all endpoints
+retry_budget = retry.RetryBudget(
+	ratio=status.get_state("retry-budget-ratio"),
+	initial=status.get_state("retry-budget-max"),
+	maximum=status.get_state("retry-budget-max"),
+)
+
+# SESSION FUNCTIONS
+
+async def open_session() -> aiohttp.ClientSession:
+	"""
+	Open the shared API session.
+	Connections are pooled and kept alive, so commands reuse them instead of opening a new one each time.
+	"""
+	global session
+	if session is not None and not session.closed:
+		return session
+	connector = aiohttp.TCPConnector(
+		limit=status.get_state("API-pool-size"),
+		limit_per_host=status.get_state("API-pool-size-per-host"),
+		keepalive_timeout=status.get_state("API-keepalive"),
+		ttl_dns_cache=status.get_state("API-dns-ttl"),
+	)
+	session = aiohttp.ClientSession(
+		connector=connector,
+		timeout=aiohttp.ClientTimeout(total=status.get_state("API-timeout")),
+	)
+	logger.info("API session opened")
+	return session
+
+async def close_session():
+	"""
+	Close the shared API session if it's open.
+	"""
+	global session
+	if session is None:
+		return
+	current, session = session, None
+	if current.closed:
+		return
+	try:
+		await current.close()
+		logger.info("API session closed")
+	except Exception as e:
+		logger.error(f"Error closing API session: {e}")
+
+async def get_session() -> aiohttp.ClientSession:
+	"""
+	Get the shared API session, opening it if needed.
+	"""
+	if session is None or session.closed:
+		return await open_session()
+	return session
+
+def timeout_for(endpoint):
+	"""
+	Timeout in seconds for an endpoint, from its timeout profile.
+	"""
+	profiles = status.get_state("endpoint-timeouts")
+	matches = [prefix for prefix in profiles if endpoint.startswith(prefix)]
+	if not matches:
+		return status.get_state("API-timeout")
+	return profiles[max(matches, key=len)]
+
+def _timeout(endpoint, timeout=None) -> dict:
+	"""
+	Build the per-call timeout arguments, from the endpoint's profile unless a timeout is given.
+	"""
+	return {"timeout": aiohttp.ClientTimeout(total=timeout if timeout is not None else timeout_for(endpoint))}
+
+def is_idempotent(method, endpoint):
+	"""
+	Whether a call can safely be retried.
+	"""
+	return method == "GET" or endpoint in status.get_state("idempotent-endpoints")
+
+@contextlib.contextmanager
+def mapped_errors(endpoint):
+	"""
+	Turn aiohttp errors into typed errors.APIError subclasses.
+	"""
+	try:
+		yield
+	except asyncio.TimeoutError as e:
+		raise errors.APITimeoutError(endpoint) from e
+	except aiohttp.ClientError as e:
+		raise errors.APIConnectionError(endpoint, str(e) or type(e).__name__) from e
+
+async def _with_retries(method, endpoint, call):
+	"""
+	Run a call, mapping its errors, and retry idempotent calls on timeouts, connection errors and 5xx answers.
+	Retries back off exponentially and are limited by the shared retry budget.
+	"""
+	attempts = 1 + (status.get_state("retry-attempts") if is_idempotent(method, endpoint) else 0)
+	delay = status.get_state("retry-delay")
+	for attempt in range(attempts):
+		try:
+			with metrics.track_api(endpoint), mapped_errors(endpoint):
+				result = await call()
+			retry_budget.record_call()
+			return result
+		except (errors.APITimeoutError, errors.APIConnectionError, errors.APIStatusError) as e:
+			retry_budget.record_call()
+			if isinstance(e, errors.APIStatusError) and e.status < 500:
+				raise
+			if attempt == attempts - 1 or not retry_budget.try_spend():
+				raise
+			logger.warning(f"{e}, retrying ({attempt + 1}/{attempts - 1})")
+			await asyncio.sleep(delay)
+			delay *= 2
+
+async def raise_for_status(endpoint, response):
+	"""
+	Raise errors.APIStatusError for an error answer, with the start of its body as detail.
+	"""
+	if response.status >= 400:
+		detail = (await response.text(errors="replace"))[:200]
+		raise errors.APIStatusError(endpoint, response.status, detail)
+
+async def read_json(endpoint, response):
+	"""
+	Read a JSON answer, raising a typed error for error statuses and non-JSON bodies (e.g. an HTML error page).
+	"""
+	await raise_for_status(endpoint, response)
+	try:
+		return await response.json()
+	except (aiohttp.ContentTypeError, ValueError) as e:
+		raise errors.APIResponseError(endpoint, f"{endpoint} answered with an unreadable body ({response.content_type})") from e
+
 # API FUNCTIONS
 
-async def api_GET(endpoint, params=None):
+async def api_GET(endpoint, params=None, timeout=None):
+	"""
+	Send a GET request to the API, retrying on failure.
+	"""
+	return await _with_retries("GET", endpoint, lambda: _get(endpoint, params, timeout))
+
+async def _get(endpoint, params=None, timeout=None):
+	client = await get_session()
+	async with health.guard(endpoint), client.get(f"{api_url}{endpoint}", params=params, **_timeout(endpoint, timeout)) as response:
+		logger.info("response status: %s", response.status, extra={"endpoint": endpoint})
+		return await read_json(endpoint, response)
+
+def normalize_payload(params):
+	"""
+	Normalize a payload so equivalent requests compare equal: strings are trimmed and inner whitespace is collapsed.
+	"""
+	if isinstance(params, str):
+		return re.sub(r"\s+", " ", params).strip()
+	if isinstance(params, dict):
+		return {key: normalize_payload(value) for key, value in params.items()}
+	if isinstance(params, (list, tuple)):
+		return [normalize_payload(value) for value in params]
+	return params
+
+def coalesce_key(endpoint, params):
+	"""
+	Key identifying a call for coalescing.
+	"""
+	return endpoint, json.dumps(normalize_payload(params), sort_keys=True)
+
+def can_coalesce(endpoint):
 	"""
-	Send a GET request to the API.
+	Whether identical concurrent calls to this endpoint may share a result.
 	"""
-	async with aiohttp.ClientSession() as session:
-		async with session.get(f"{api_url}{endpoint}", params=params) as response:
-			logger.info(f"response status: {response.status}")
-			return await response.json()
+	return endpoint in status.get_state("coalesce-endpoints")
 
-async def api_POST(endpoint, params=None):
+async def api_POST(endpoint, params=None, timeout=None):
 	"""
 	Send a POST request to the API.
+	Failures raise errors.APIError subclasses; idempotent endpoints are retried within the retry budget.
+	Fails fast with errors.ServiceUnavailableError while the endpoint's service is down.
+	For coalescing endpoints, duplicates of a call already in flight wait for it and share its result.
+	Pre-generated answers are served when ready.
+	"""
+	response = pregen.take(endpoint, params)
+	if response is not None:
+		return response
+	response = await api_POST_live(endpoint, params, timeout)
+	if pregen.enabled(endpoint):
+		pregen.remember(endpoint, params, response)
+	return response
+
+async def api_POST_live(endpoint, params=None, timeout=None):
+	"""
+	Send a POST request to the API, skipping pre-generated answers.
+	"""
+	return await _coalesced(endpoint, params, lambda: _with_retries("POST", endpoint, lambda: _post(endpoint, params, timeout)))
+
+async def api_POST_image(endpoint, params=None, timeout=None):
+	"""
+	Send a POST request to an image endpoint and return (image bytes, metadata).
+	A raw image/png body is preferred, with metadata in X- headers (e.g. X-Generation-Time -> generation_time).
+	APIs that only answer with base64 in JSON are still supported.
+	"""
+	return await _coalesced(endpoint, params, lambda: _with_retries("POST", endpoint, lambda: _request_image("POST", endpoint, params, timeout)), transport="binary")
+
+async def _coalesced(endpoint, params, call, transport="json"):
+	"""
+	Run a call through admission control and coalescing.
+	The caller is charged against the rate limits even when joining a call in flight; only the call itself holds a service slot.
+	"""
+	admission.check(endpoint)
+	warmup.called(endpoint)
+	if can_coalesce(endpoint):
+		return await generation_flight.do((transport,) + coalesce_key(endpoint, params), lambda: admission.admit(endpoint, call))
+	return await admission.admit(endpoint, call)
+
+async def _post(endpoint, params=None, timeout=None):
+	client = await get_session()
+	async with health.guard(endpoint), client.post(f"{api_url}{endpoint}", json=params, **_timeout(endpoint, timeout)) as response:
+		logger.info("response status: %s", response.status, extra={"endpoint": endpoint})
+		return await read_json(endpoint, response)
+
+async def _request_image(method, endpoint, params=None, timeout=None):
+	client = await get_session()
+	headers = {"Accept": "image/png, application/json;q=0.5"}
+	async with health.guard(endpoint), client.request(method, f"{api_url}{endpoint}", json=params, headers=headers, **_timeout(endpoint, timeout)) as response:
+		logger.info("response status: %s", response.status, extra={"endpoint": endpoint})
+		return await read_image(endpoint, response)
+
+async def read_image(endpoint, response):
+	"""
+	Read an image answer: a raw image body with X- metadata headers, or base64 in JSON.
+	"""
+	await raise_for_status(endpoint, response)
+	if response.content_type.startswith("image/"):
+		return await response.read(), image_metadata(response.headers)
+	body = await read_json(endpoint, response)
+	return decode_image_result(body["result"])
+
+async def api_POST_upload(endpoint, data, filename, content_type, timeout=None):
+	"""
+	Upload an image to {endpoint}/upload as multipart form data (field "image") and return (image bytes, metadata).
+	Returns None if the API doesn't accept uploads for this endpoint, so callers can send a url instead.
+	"""
+	digest = hashlib.sha256(data).hexdigest()
+	return await _coalesced(endpoint, {"sha256": digest}, lambda: _with_retries("POST", endpoint, lambda: _upload_image(endpoint, data, filename, content_type, timeout)), transport="upload")
+
+async def _upload_image(endpoint, data, filename, content_type, timeout=None):
+	client = await get_session()
+	form = aiohttp.FormData()
+	form.add_field("image", data, filename=filename, content_type=content_type)
+	headers = {"Accept": "image/png, application/json;q=0.5"}
+	async with health.guard(endpoint), client.post(f"{api_url}{endpoint}/upload", data=form, headers=headers, **_timeout(endpoint, timeout)) as response:
+		logger.info("response status: %s", response.status, extra={"endpoint": endpoint})
+		if response.status in (404, 405, 415, 501):
+			logger.info(f"Uploads not supported for {endpoint}, falling back to a url")
+			return None
+		return await read_image(endpoint, response)
+
+def image_metadata(headers):
+	"""
+	Read image metadata from X- response headers, e.g. X-Total-Energy-Nespresso -> total_energy_nespresso.
+	"""
+	metadata = {}
+	for key, value in headers.items():
+		if key.lower().startswith("x-"):
+			metadata[key[2:].lower().replace("-", "_")] = value
+	return metadata
+
+def decode_image_result(result):
+	"""
+	Decode a JSON image result: either a base64 string or a dict with a 'b64' field and metadata.
+	"""
+	if isinstance(result, str):
+		return base64.b64decode(result), {}
+	metadata = {key: value for key, value in result.items() if key != "b64"}
+	return base64.b64decode(result["b64"]), metadata
+
+async def api_POST_stream(endpoint, params=None, timeout=None):
+	"""
+	Send a POST request to the API and yield the answer text as it's generated.
+	Server-sent events (data: lines) and plain chunked text are both supported.
+	A regular JSON answer is yielded in one piece.
+	Streams are never retried, since part of the answer may already be shown.
+	"""
+	admission.check(endpoint)
+	warmup.called(endpoint)
+	async with admission.slot(endpoint):
+		with metrics.track_api(endpoint), mapped_errors(endpoint):
+			async for chunk in _stream(endpoint, params, timeout):
+				yield chunk
+
+async def _stream(endpoint, params=None, timeout=None):
+	client = await get_session()
+	headers = {"Accept": "text/event-stream, text/plain;q=0.9, application/json;q=0.5"}
+	async with health.guard(endpoint), client.post(f"{api_url}{endpoint}", json=params, headers=headers, **_timeout(endpoint, timeout)) as response:
+		logger.info("response status: %s", response.status, extra={"endpoint": endpoint})
+		await raise_for_status(endpoint, response)
+		if response.content_type == "text/event-stream":
+			async for line in response.content:
+				chunk = sse_chunk(line.decode("utf-8").rstrip("\r\n"))
+				if chunk is None:
+					break
+				if chunk:
+					yield chunk
+		elif response.content_type == "text/plain":
+			decoder = codecs.getincrementaldecoder("utf-8")()
+			async for data in response.content.iter_any():
+				chunk = decoder.decode(data)
+				if chunk:
+					yield chunk
+		else:
+			body = await read_json(endpoint, response)
+			yield body["result"]
+
+def sse_chunk(line):
+	"""
+	Extract the text carried by one server-sent event line.
+	Returns "" for lines without text and None for the end of stream marker.
+	"""
+	if not line.startswith("data:"):
+		return ""
+	data = line[5:]
+	if data.startswith(" "):
+		data = data[1:]
+	if data == "[DONE]":
+		return None
+	try:
+		event = json.loads(data)
+	except ValueError:
+		return data
+	if isinstance(event, dict):
+		for key in ("token", "delta", "text", "result"):
+			if isinstance(event.get(key), str):
+				return event[key]
+		return ""
+	return data
+
+async def fetch_url(url, max_bytes):
+	"""
+	Download a file, such as an image to process.
+	Returns None if it's larger than max_bytes.
+	"""
+	client = await get_session()
+	with mapped_errors(url):
+		async with client.get(url, **_timeout(url, status.get_state("job-request-timeout"))) as response:
+			await raise_for_status(url, response)
+			if response.content_length is not None and response.content_length > max_bytes:
+				return None
+			data = await response.content.read(max_bytes + 1)
+	if len(data) > max_bytes:
+		return None
+	return data
+
+# JOB FUNCTIONS
+
+# Endpoints whose API answered that it doesn't support jobs, with the time it did
+jobs_unsupported: Dict[str, float] = {}
+
+def jobs_supported(endpoint):
+	"""Whether to try a job for this endpoint: not after it answered it doesn't support them, until job-support-recheck"""
+	marked_at = jobs_unsupported.get(endpoint)
+	return marked_at is None or time.monotonic() - marked_at > status.get_state("job-support-recheck")
+
+async def submit_job(endpoint, params=None):
+	"""
+	Submit a generation job to {endpoint}/jobs and return its id.
+	Returns None if the API doesn't support jobs for this endpoint, so callers can fall back to a blocking call.
+	After the API said so, it isn't asked again for job-support-recheck seconds.
+	Identical concurrent submissions share the same job.
+	"""
+	if not status.get_state("jobs-enabled") or not jobs_supported(endpoint):
+		return None
+	return await _coalesced(endpoint, params, lambda: _with_retries("POST", endpoint, lambda: _submit_job(endpoint, params)), transport="job")
+
+async def _submit_job(endpoint, params=None):
+	client = await get_session()
+	timeout = status.get_state("job-request-timeout")
+	async with health.guard(endpoint), client.post(f"{api_url}{endpoint}/jobs", json=params, **_timeout(endpoint, timeout)) as response:
+		logger.info("response status: %s", response.status, extra={"endpoint": endpoint})
+		if response.status in (404, 405, 501):
+			logger.info(f"Jobs not supported for {endpoint}, falling back to a blocking call")
+			jobs_unsupported[endpoint] = time.monotonic()
+			return None
+		body = await read_json(endpoint, response)
+	return body["job_id"]
+
+async def wait_for_job(endpoint, job_id, on_progress=None):
+	"""
+	Poll a job until it's done and return (image bytes, metadata).
+	on_progress is awaited with the job status (status, position, eta, progress) each time it changes.
+	Each poll is a short request, so long or queued jobs don't hold a socket open.
+	"""
+	interval = status.get_state("job-poll-interval")
+	timeout = status.get_state("job-request-timeout")
+	deadline = asyncio.get_running_loop().time() + status.get_state("job-timeout")
+	last = None
+	while True:
+		job = await api_GET(f"{endpoint}/jobs/{job_id}", timeout=timeout)
+		state = job.get("status")
+		if state == "done":
+			return await _with_retries("GET", endpoint, lambda: _request_image("GET", f"{endpoint}/jobs/{job_id}/result", timeout=timeout))
+		if state == "failed":
+			raise errors.APIError(endpoint, job.get("error") or f"Job {job_id} failed")
+		if on_progress and job != last:
+			last = job
+			try:
+				await on_progress(job)
+			except Exception as e:
+				logger.warning(f"Progress update for job {job_id} failed: {e}")
+		if asyncio.get_running_loop().time() > deadline:
+			raise errors.APITimeoutError(endpoint)
+		await asyncio.sleep(interval)
+
+async def get_quote(endpoint):
+	"""
+	Get a currency quote, served from the quote cache while fresh.
+	Concurrent requests for the same endpoint share one upstream call.
 	"""
-	async with aiohttp.ClientSession() as session:
-		async with session.post(f"{api_url}{endpoint}", json=params) as response:
-			logger.info(f"response status: {response.status}")
-			return await response.json()
+	return await quote_cache.get(endpoint, lambda: api_POST(endpoint, None))
 
 # SETUP FUNCTIONS
 
@@ -0,0 +1,71 @@
+"""
+Gateway cache profiles: which events the bot receives and what discord.py keeps in memory.
+
+A profile (see "cache-profiles" in status.py) sets:
+- intents: intent names, "default" for discord.py's defaults or "all"
+- member-cache: MemberCacheFlags to enable ("voice", "joined")
+- max-messages: messages kept in the message cache, None for no cache
+- chunk-guilds-at-startup: download every member list on connect (no command needs them, so lean doesn't)
+"""
+import discord
+import logging
+import metrics
+import status
+from typing import Any, Dict, Iterable
+
+logger = logging.getLogger('discord')
+
+def intents(names: Iterable[str]) -> discord.Intents:
+	result = discord.Intents.none()
+	for name in names:
+		if name == "default":
+			result.value |= discord.Intents.default().value
+		elif name == "all":
+			result.value |= discord.Intents.all().value
+		elif name in discord.Intents.VALID_FLAGS:
+			setattr(result, name, True)
+		else:
+			raise ValueError(f"Unknown intent: {name}")
+	return result
+
+def member_cache_flags(names: Iterable[str]) -> discord.MemberCacheFlags:
+	result = discord.MemberCacheFlags.none()
+	for name in names:
+		if name not in discord.MemberCacheFlags.VALID_FLAGS:
+			raise ValueError(f"Unknown member cache flag: {name}")
+		setattr(result, name, True)
+	return result
+
+def options(name: str) -> Dict[str, Any]:
+	"""Client options for a cache profile"""
+	profile = status.get_state("cache-profiles")[name]
+	return {
+		"intents": intents(profile["intents"]),
+		"member_cache_flags": member_cache_flags(profile["member-cache"]),
+		"max_messages": profile["max-messages"],
+		"chunk_guilds_at_startup": profile["chunk-guilds-at-startup"],
+	}
+
+def cache_sizes(client: discord.Client) -> Dict[str, int]:
+	"""Number of objects in each of discord.py's caches"""
+	return {
+		"guilds": len(client.guilds),
+		"members": sum(len(guild.members) for guild in client.guilds),
+		"users": len(client.users),
+		"channels": sum(len(guild.channels) for guild in client.guilds),
+		"roles": sum(len(guild.roles) for guild in client.guilds),
+		"emojis": len(client.emojis),
+		"stickers": len(client.stickers),
+		"messages": len(client.cached_messages),
+	}
+
+def report(client: discord.Client):
+	"""Log and export the cache sizes and the memory in use"""
+	import psutil
+	sizes = cache_sizes(client)
+	for cache, size in sizes.items():
+		metrics.gateway_cache_entries.set(cache, value=size)
+	rss = psutil.Process().memory_info().rss
+	metrics.memory_rss_bytes.set(value=rss)
+	logger.info("Cache profile %s - %s, %.1f MB in use",
+		status.get_state("cache-profile"), ", ".join(f"{size} {cache}" for cache, size in sizes.items()), rss / 2**20)
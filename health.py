@@ -0,0 +1,173 @@
+"""
+Health monitoring of the Domestic AI services, with a circuit breaker per service.
+"""
+import aiohttp
+import asyncio
+import contextlib
+import errors
+import logging
+import status
+import time
+from typing import Dict, List
+
+logger = logging.getLogger('discord')
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+STARTING = "starting"
+
+class CircuitBreaker:
+	"""
+	Track a service's failures.
+	After failure_threshold consecutive failures the circuit opens and calls fail fast.
+	After reset_timeout seconds it goes half-open: calls are let through and the next result closes or reopens it.
+	"""
+	def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+		self.name = name
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.state = CLOSED
+		self.failures = 0
+		self.opened_at = 0.0
+
+	def allow(self) -> bool:
+		"""Whether a call to the service may go through"""
+		if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+			self.state = HALF_OPEN
+			logger.info(f"Circuit for {self.name} is half-open")
+		return self.state not in (OPEN, STARTING)
+
+	def record_success(self):
+		if self.state != CLOSED:
+			logger.info(f"Circuit for {self.name} closed")
+		self.state = CLOSED
+		self.failures = 0
+
+	def record_failure(self):
+		self.failures += 1
+		if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+			self.trip()
+
+	def hold(self):
+		"""Refuse calls until the service is confirmed ready (by record_success)"""
+		self.state = STARTING
+
+	def trip(self):
+		"""Open the circuit"""
+		if self.state != OPEN:
+			logger.warning(f"Circuit for {self.name} opened")
+		self.state = OPEN
+		self.opened_at = time.monotonic()
+
+# Circuit breakers, by service name
+breakers: Dict[str, CircuitBreaker] = {}
+
+def breaker(service_name: str) -> CircuitBreaker:
+	"""Get the circuit breaker of a service"""
+	if service_name not in breakers:
+		breakers[service_name] = CircuitBreaker(
+			service_name,
+			failure_threshold=status.get_state("breaker-failure-threshold"),
+			reset_timeout=status.get_state("breaker-reset-timeout"),
+		)
+	return breakers[service_name]
+
+def service_for(endpoint: str) -> str:
+	"""Name of the service behind an endpoint, by longest matching prefix ("API" by default)"""
+	matches = [prefix for prefix in status.get_state("endpoint-services") if endpoint.startswith(prefix)]
+	if not matches:
+		return "API"
+	return status.get_state("endpoint-services")[max(matches, key=len)]
+
+@contextlib.asynccontextmanager
+async def guard(endpoint: str):
+	"""
+	Wrap a call to an endpoint with its service's circuit breaker.
+	Raises errors.ServiceUnavailableError without calling if the circuit is open.
+	"""
+	service_breaker = breaker(service_for(endpoint))
+	if not service_breaker.allow():
+		raise errors.ServiceUnavailableError(service_breaker.name, endpoint)
+	try:
+		yield
+	except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+		service_breaker.record_failure()
+		raise
+	except errors.APIStatusError as e:
+		if e.status >= 500:
+			service_breaker.record_failure()
+		else:
+			service_breaker.record_success()
+		raise
+	service_breaker.record_success()
+
+# MONITOR
+
+# Restart bookkeeping, by service name
+probe_failures: Dict[str, int] = {}
+restart_delays: Dict[str, float] = {}
+next_restarts: Dict[str, float] = {}
+restarts: Dict[str, asyncio.Task] = {}
+
+PROBE_TIMEOUT = 2
+
+def in_flight(service_name: str) -> bool:
+	"""Whether this process has admitted calls to the service that haven't finished"""
+	# Imported here: admission imports this module
+	import admission
+	service_limiter = admission.limiters.get(service_name)
+	return service_limiter is not None and service_limiter.active > 0
+
+async def check_services(services: List, session: aiohttp.ClientSession) -> Dict[str, bool]:
+	"""
+	Probe every service, update its circuit breaker and restart dead ones with backoff.
+	A service is restarted once restart-after probes in a row failed (breaker-failure-threshold by default).
+	Failed probes don't count while the service has calls in flight: it may just be busy with a long generation.
+	"""
+	timeouts = status.get_state("probe-timeouts")
+	results = await asyncio.gather(*(service.is_running(session, timeouts.get(service.name, PROBE_TIMEOUT)) for service in services))
+	for service, running in zip(services, results):
+		if running:
+			breaker(service.name).record_success()
+			probe_failures.pop(service.name, None)
+			restart_delays.pop(service.name, None)
+			next_restarts.pop(service.name, None)
+		elif in_flight(service.name):
+			logger.info(f"{service.name} is not responding, but has calls in flight")
+		else:
+			logger.warning(f"{service.name} is not responding")
+			service_breaker = breaker(service.name)
+			service_breaker.record_failure()
+			probe_failures[service.name] = probe_failures.get(service.name, 0) + 1
+			threshold = status.get_state("restart-after").get(service.name, status.get_state("breaker-failure-threshold"))
+			if service_breaker.state == OPEN and probe_failures[service.name] >= threshold:
+				schedule_restart(service)
+	return {service.name: running for service, running in zip(services, results)}
+
+def schedule_restart(service):
+	"""Restart a dead service in the background, doubling the wait between attempts"""
+	# In a cluster only the coordinator restarts services
+	if not status.get_state("auto-restart") or not status.get_state("service-owner") or not service.command_path:
+		return
+	if service.name in restarts and not restarts[service.name].done():
+		return
+	now = time.monotonic()
+	if now < next_restarts.get(service.name, 0):
+		return
+	delay = restart_delays.get(service.name, status.get_state("restart-initial-delay"))
+	restart_delays[service.name] = min(delay * 2, status.get_state("restart-max-delay"))
+	next_restarts[service.name] = now + delay
+	logger.info(f"Restarting {service.name}, next attempt in {delay}s if it fails")
+	restarts[service.name] = asyncio.create_task(restart(service))
+
+async def restart(service):
+	# Never kill a service in the middle of a user's call
+	if in_flight(service.name):
+		logger.info(f"Not restarting {service.name}, it has calls in flight")
+		return
+	# A hung service still holds its port, and a new copy couldn't bind it
+	await service.stop()
+	if await service.start():
+		breaker(service.name).record_success()
+		probe_failures.pop(service.name, None)
@@ -0,0 +1,115 @@
+"""
+Logging pipeline that keeps formatting and writing off the event loop.
+
+Records are put on a queue as they are, with their arguments truncated (long strings, base64 and bytes are
+summarized), and a listener thread formats and writes them. Records can carry structured fields
+(command, user, guild, latency, payload size), which are appended as key=value pairs.
+"""
+import logging
+import logging.handlers
+import metrics
+import queue
+import re
+import sys
+from typing import Any, Dict, Optional
+
+STRUCTURED_FIELDS = ("command", "user", "guild", "endpoint", "latency", "payload_size")
+BASE64_PATTERN = re.compile(r"^[A-Za-z0-9+/=\s]+$")
+MAX_FIELD = 300 # characters kept of a long string
+MAX_ITEMS = 20 # items kept of a long list or dict
+MAX_DEPTH = 3
+
+listener: Optional[logging.handlers.QueueListener] = None
+
+def truncate(value: Any, depth: int = 0) -> Any:
+	"""A log-friendly copy of value: big strings, base64 blobs and bytes are replaced by short summaries"""
+	if isinstance(value, (bytes, bytearray, memoryview)):
+		return f"<{len(value)} bytes>"
+	if isinstance(value, str):
+		if len(value) <= MAX_FIELD:
+			return value
+		if BASE64_PATTERN.match(value[:MAX_FIELD]) and " " not in value[:MAX_FIELD]:
+			return f"<base64, {len(value)} chars>"
+		return f"{value[:MAX_FIELD]}… <{len(value)} chars>"
+	if depth >= MAX_DEPTH:
+		return value if isinstance(value, (int, float, bool, type(None))) else f"<{type(value).__name__}>"
+	if isinstance(value, dict):
+		items = list(value.items())
+		result = {key: truncate(item, depth + 1) for key, item in items[:MAX_ITEMS]}
+		if len(items) > MAX_ITEMS:
+			result["…"] = f"{len(items) - MAX_ITEMS} more"
+		return result
+	if isinstance(value, (list, tuple)):
+		result = [truncate(item, depth + 1) for item in value[:MAX_ITEMS]]
+		if len(value) > MAX_ITEMS:
+			result.append(f"… {len(value) - MAX_ITEMS} more")
+		return result
+	return value
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+	"""
+	Queue records without formatting them, after truncating their arguments.
+	Formatting happens in the listener thread, so the event loop only pays for the truncation.
+	"""
+	def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+		if isinstance(record.msg, str) and not record.args:
+			record.msg = truncate(record.msg)
+		if isinstance(record.args, dict):
+			record.args = truncate(record.args)
+		elif record.args:
+			record.args = tuple(truncate(arg) for arg in record.args)
+		for field in STRUCTURED_FIELDS:
+			if hasattr(record, field):
+				setattr(record, field, truncate(getattr(record, field)))
+		if record.exc_info and not record.exc_text:
+			# Tracebacks hold frames that may change once the loop moves on
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+class StructuredFormatter(logging.Formatter):
+	"""Standard format followed by the record's structured fields as key=value"""
+	def format(self, record: logging.LogRecord) -> str:
+		message = super().format(record)
+		fields = [f"{field}={getattr(record, field)}" for field in STRUCTURED_FIELDS if getattr(record, field, None) is not None]
+		if fields:
+			message += " | " + " ".join(fields)
+		return message
+
+def fields(interaction=None, **values) -> Dict[str, Any]:
+	"""Structured fields for a record's extra, taken from an interaction and keyword values"""
+	result = {}
+	if interaction is not None:
+		command = getattr(interaction, "command", None)
+		result["command"] = command.name if command is not None else None
+		result["user"] = interaction.user.id
+		result["guild"] = interaction.guild_id
+		result["latency"] = metrics.command_latency(interaction)
+	result.update(values)
+	return result
+
+def setup(level: int = logging.INFO, prefix: str = ""):
+	"""
+	Send every log record through the queue to a listener thread writing to stderr.
+	prefix starts every line, to tell apart processes writing to the same terminal.
+	"""
+	global listener
+	if listener is not None:
+		return
+	log_queue = queue.SimpleQueue()
+	handler = logging.StreamHandler(sys.stderr)
+	handler.setFormatter(StructuredFormatter("[{asctime}] [{levelname:<8}] " + prefix + "{name}: {message}", "%Y-%m-%d %H:%M:%S", style="{"))
+	listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+	root = logging.getLogger()
+	root.setLevel(level)
+	for old_handler in list(root.handlers):
+		root.removeHandler(old_handler)
+	root.addHandler(TruncatingQueueHandler(log_queue))
+	listener.start()
+
+def shutdown():
+	"""Write the records still in the queue and stop the listener"""
+	global listener
+	if listener is not None:
+		listener.stop()
+		listener = None
@@ -0,0 +1,220 @@
+"""
+Command latency and throughput metrics, exposed as Prometheus text on a local port.
+"""
+import contextlib
+import datetime
+import logging
+import math
+import re
+import status
+import time
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+	from aiohttp import web
+
+logger = logging.getLogger('discord')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _escape(value) -> str:
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+	if not names:
+		return ""
+	return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+class Metric:
+	"""Base class for a metric with optional labels"""
+	kind = "untyped"
+
+	def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+		self.name = name
+		self.documentation = documentation
+		self.label_names = labels
+		registry[name] = self
+
+	def render(self) -> str:
+		return f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n" + "".join(self.samples())
+
+	def samples(self):
+		raise NotImplementedError
+
+class Counter(Metric):
+	"""A value that only goes up"""
+	kind = "counter"
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.values: Dict[Tuple[str, ...], float] = {}
+
+	def inc(self, *labels: str, amount: float = 1):
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+	def samples(self):
+		for labels, value in self.values.items():
+			yield f"{self.name}{_labels(self.label_names, labels)} {value}\n"
+
+class Gauge(Counter):
+	"""A value that goes up and down"""
+	kind = "gauge"
+
+	def dec(self, *labels: str, amount: float = 1):
+		self.inc(*labels, amount=-amount)
+
+	def set(self, *labels: str, value: float):
+		self.values[labels] = value
+
+class Histogram(Metric):
+	"""Observations counted in cumulative buckets"""
+	kind = "histogram"
+
+	def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.buckets = buckets
+		self.counts: Dict[Tuple[str, ...], list] = {}
+		self.sums: Dict[Tuple[str, ...], float] = {}
+
+	def observe(self, *labels: str, value: float):
+		counts = self.counts.setdefault(labels, [0] * (len(self.buckets) + 1))
+		for index, bound in enumerate(self.buckets):
+			if value <= bound:
+				counts[index] += 1
+		counts[-1] += 1
+		self.sums[labels] = self.sums.get(labels, 0) + value
+
+	def samples(self):
+		for labels, counts in self.counts.items():
+			for bound, count in zip(self.buckets + (math.inf,), counts):
+				le = "+Inf" if bound == math.inf else repr(float(bound))
+				yield f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + (le,))} {count}\n"
+			yield f"{self.name}_sum{_labels(self.label_names, labels)} {self.sums[labels]}\n"
+			yield f"{self.name}_count{_labels(self.label_names, labels)} {counts[-1]}\n"
+
+registry: Dict[str, Metric] = {}
+
+def render() -> str:
+	"""All metrics in the Prometheus text format"""
+	return "".join(metric.render() for metric in registry.values())
+
+# METRICS
+
+commands_total = Counter("roby_commands_total", "Slash commands received", ("command",))
+command_errors_total = Counter("roby_command_errors_total", "Slash commands that failed", ("command",))
+commands_in_flight = Gauge("roby_commands_in_flight", "Slash commands being handled", ("command",))
+command_defer_seconds = Histogram("roby_command_defer_seconds", "Time from interaction receipt to defer()", ("command",))
+command_seconds = Histogram("roby_command_seconds", "Time from interaction receipt to the reply being sent", ("command",))
+api_request_seconds = Histogram("roby_api_request_seconds", "Upstream Domestic API latency", ("endpoint",))
+api_errors_total = Counter("roby_api_errors_total", "Failed Domestic API calls", ("endpoint", "error"))
+api_in_flight = Gauge("roby_api_in_flight", "Domestic API calls in flight", ("endpoint",))
+startup_seconds = Gauge("roby_startup_seconds", "Duration of each startup phase", ("phase",))
+gateway_cache_entries = Gauge("roby_gateway_cache_entries", "Objects in discord.py's caches", ("cache",))
+memory_rss_bytes = Gauge("roby_memory_rss_bytes", "Resident memory of the bot process")
+model_command_seconds = Histogram("roby_model_command_seconds", "Latency of commands that found their model cold or warm", ("endpoint", "model"))
+warmups_total = Counter("roby_warmups_total", "Warm-up calls sent to model-backed endpoints", ("endpoint",))
+shard_latency_seconds = Gauge("roby_shard_latency_seconds", "Gateway heartbeat latency by shard", ("shard",))
+
+# COMMAND TRACKING
+
+# Receipt time of the interactions being handled, by interaction id
+received: Dict[int, Tuple[str, float]] = {}
+STALE_AFTER = 900 # interactions expire after 15 minutes
+
+def command_name(interaction) -> str:
+	if interaction.command is not None:
+		return interaction.command.qualified_name
+	return (interaction.data or {}).get("name", "unknown")
+
+def command_received(interaction):
+	"""
+	Record the receipt of a slash command, before its callback runs.
+	Times start when Discord created the interaction, so the wait for the event loop is counted too.
+	"""
+	now = time.monotonic()
+	for interaction_id, (_, started_at) in list(received.items()):
+		if now - started_at > STALE_AFTER:
+			command_done(interaction_id)
+	name = command_name(interaction)
+	# Clamped, in case the local clock is behind Discord's
+	age = max(0.0, (datetime.datetime.now(datetime.timezone.utc) - interaction.created_at).total_seconds())
+	received[interaction.id] = (name, now - age)
+	commands_total.inc(name)
+	commands_in_flight.inc(name)
+
+def command_deferred(interaction):
+	"""Record the time from receipt to defer()"""
+	if interaction.id in received:
+		name, started_at = received[interaction.id]
+		command_defer_seconds.observe(name, value=time.monotonic() - started_at)
+
+def command_finished(interaction, error: bool = False):
+	"""Record the total time of a slash command"""
+	if interaction.id not in received:
+		return
+	name, started_at = received[interaction.id]
+	if error:
+		command_errors_total.inc(name)
+	else:
+		command_seconds.observe(name, value=time.monotonic() - started_at)
+	command_done(interaction.id)
+
+def command_latency(interaction) -> Optional[float]:
+	"""Seconds since the receipt of a slash command still being handled, or None"""
+	if interaction.id not in received:
+		return None
+	return round(time.monotonic() - received[interaction.id][1], 3)
+
+def command_done(interaction_id: int):
+	name, _ = received.pop(interaction_id)
+	commands_in_flight.dec(name)
+
+# API TRACKING
+
+def endpoint_label(endpoint: str) -> str:
+	"""Endpoint label without ids, so job polls share one series"""
+	return re.sub(r"/jobs/[^/]+", "/jobs/{id}", endpoint)
+
+@contextlib.contextmanager
+def track_api(endpoint: str):
+	"""Record the latency and outcome of one upstream API call"""
+	label = endpoint_label(endpoint)
+	api_in_flight.inc(label)
+	started_at = time.monotonic()
+	try:
+		yield
+	except Exception as e:
+		api_errors_total.inc(label, type(e).__name__)
+		raise
+	finally:
+		api_in_flight.dec(label)
+		api_request_seconds.observe(label, value=time.monotonic() - started_at)
+
+# SCRAPE ENDPOINT
+
+runner: Optional["web.AppRunner"] = None
+
+async def handle_metrics(request: "web.Request") -> "web.Response":
+	from aiohttp import web
+	return web.Response(text=render(), content_type="text/plain")
+
+async def start_server():
+	"""Serve the metrics on localhost at /metrics, if a metrics port is set"""
+	global runner
+	port = status.get_state("metrics-port")
+	if not port or runner is not None:
+		return
+	# The web server is only loaded when a metrics port is set
+	from aiohttp import web
+	app = web.Application()
+	app.router.add_get("/metrics", handle_metrics)
+	runner = web.AppRunner(app, access_log=None)
+	await runner.setup()
+	await web.TCPSite(runner, "127.0.0.1", port).start()
+	logger.info(f"Metrics available at http://127.0.0.1:{port}/metrics")
+
+async def stop_server():
+	global runner
+	if runner is not None:
+		await runner.cleanup()
+		runner = None
@@ -0,0 +1,164 @@
+"""
+Pools of pre-generated answers for endpoints that are slow but often called with the same arguments
+(/joke, /wisdom and /wdyt take none, /haiku is often asked about the same few topics).
+
+routine_function refills the pools while the backend is idle, and commands are served from them instantly,
+falling back to a live call when their pool is empty.
+"""
+import admission
+import asyncio
+import collections
+import hashlib
+import health
+import json
+import logging
+import re
+import status
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class Pool:
+	"""Ready answers for one endpoint and payload"""
+	def __init__(self, endpoint: str, params: Optional[dict], size: int, no_repeat: int):
+		self.endpoint = endpoint
+		self.params = params
+		self.size = size
+		self.ready: Deque[dict] = collections.deque()
+		# Fingerprints of the answers served lately, which aren't pooled again
+		self.recent: Deque[str] = collections.deque(maxlen=no_repeat)
+		self.served = 0
+
+	def take(self) -> Optional[dict]:
+		if not self.ready:
+			return None
+		response = self.ready.popleft()
+		self.remember(response)
+		self.served += 1
+		return response
+
+	def put(self, response: dict) -> bool:
+		"""Pool an answer unless it repeats a recent or pooled one"""
+		fingerprint = answer_fingerprint(response)
+		if fingerprint in self.recent or any(answer_fingerprint(ready) == fingerprint for ready in self.ready):
+			return False
+		self.ready.append(response)
+		return True
+
+	def remember(self, response: dict):
+		self.recent.append(answer_fingerprint(response))
+
+	def missing(self) -> int:
+		return self.size - len(self.ready)
+
+def answer_fingerprint(response: dict) -> str:
+	return hashlib.sha256(json.dumps(response.get("result"), sort_keys=True, default=str).encode()).hexdigest()
+
+def normalize(params):
+	"""Case- and whitespace-insensitive payload, so "Cats" and " cats" share a pool"""
+	if isinstance(params, str):
+		return re.sub(r"\s+", " ", params).strip().casefold()
+	if isinstance(params, dict):
+		return {key: normalize(value) for key, value in params.items()}
+	return params
+
+def pool_key(endpoint: str, params: Optional[dict]) -> Tuple[str, str]:
+	return endpoint, json.dumps(normalize(params), sort_keys=True)
+
+# Pools, by endpoint and normalized payload
+pools: Dict[Tuple[str, str], Pool] = {}
+
+# Refill running in the background, started by start_refill
+refilling: Optional[asyncio.Task] = None
+
+# Payloads asked for lately, by endpoint, to learn which ones deserve a pool
+demand: Dict[str, Deque[str]] = collections.defaultdict(lambda: collections.deque(maxlen=200))
+
+def enabled(endpoint: str) -> bool:
+	return status.get_state("pregen-enabled") and endpoint in status.get_state("pregen-endpoints")
+
+def take(endpoint: str, params: Optional[dict]) -> Optional[dict]:
+	"""A pre-generated answer for this call, or None"""
+	if not enabled(endpoint):
+		return None
+	key = pool_key(endpoint, params)
+	if params:
+		demand[endpoint].append(key[1])
+	pool = pools.get(key)
+	return pool.take() if pool else None
+
+def remember(endpoint: str, params: Optional[dict], response: dict):
+	"""Note an answer served live, so the pool won't repeat it soon"""
+	pool = pools.get(pool_key(endpoint, params))
+	if pool:
+		pool.remember(response)
+
+def wanted() -> List[Tuple[str, Optional[dict]]]:
+	"""Endpoints and payloads to keep pools for: those without arguments, configured ones and the most asked for"""
+	targets = []
+	configured = status.get_state("pregen-params")
+	for endpoint in status.get_state("pregen-endpoints"):
+		payloads = [json.dumps(normalize(params), sort_keys=True) for params in configured.get(endpoint, [])]
+		if endpoint not in configured:
+			payloads.append(json.dumps(None))
+		for payload, _ in collections.Counter(demand[endpoint]).most_common(status.get_state("pregen-top-params")):
+			if payload not in payloads:
+				payloads.append(payload)
+		targets += [(endpoint, json.loads(payload)) for payload in payloads]
+	return targets
+
+def backend_idle(endpoint: str) -> bool:
+	"""Whether the endpoint's service has spare capacity and is up"""
+	service = health.service_for(endpoint)
+	limiter = admission.limiter(service)
+	return limiter.active == 0 and limiter.waiting == 0 and health.breaker(service).state == health.CLOSED
+
+async def refill(generate: Callable[[str, Optional[dict]], Awaitable[dict]]) -> int:
+	"""
+	Generate up to pregen-refill-per-tick answers for the emptiest pools, while their backend is idle.
+	generate makes a live API call. Returns how many answers were pooled.
+	"""
+	if not status.get_state("pregen-enabled"):
+		return 0
+	size = status.get_state("pregen-size")
+	no_repeat = status.get_state("pregen-no-repeat")
+	targets = wanted()
+	for endpoint, params in targets:
+		key = pool_key(endpoint, params)
+		if key not in pools:
+			pools[key] = Pool(endpoint, params, size, no_repeat)
+	# Drop pools nobody asks for anymore
+	keys = {pool_key(endpoint, params) for endpoint, params in targets}
+	for key in [key for key in pools if key not in keys]:
+		del pools[key]
+
+	pooled = 0
+	for _ in range(status.get_state("pregen-refill-per-tick")):
+		candidates = [pool for pool in pools.values() if pool.missing() > 0 and backend_idle(pool.endpoint)]
+		if not candidates:
+			break
+		pool = max(candidates, key=lambda pool: pool.missing())
+		try:
+			response = await generate(pool.endpoint, pool.params)
+		except Exception as e:
+			logger.warning(f"Pre-generation for {pool.endpoint} failed: {e}")
+			break
+		if pool.put(response):
+			pooled += 1
+	return pooled
+
+def _log_failure(task: asyncio.Task):
+	if not task.cancelled() and task.exception():
+		logger.warning(f"Pre-generation failed: {task.exception()}")
+
+def start_refill(generate: Callable[[str, Optional[dict]], Awaitable[dict]]) -> bool:
+	"""Start a refill in the background, unless the previous one is still running. Returns whether one was started."""
+	global refilling
+	if refilling is not None and not refilling.done():
+		return False
+	refilling = asyncio.create_task(refill(generate))
+	refilling.add_done_callback(_log_failure)
+	return True
+
+def stats() -> Dict[str, Dict[str, int]]:
+	return {f"{pool.endpoint} {pool.params or ''}".strip(): {"ready": len(pool.ready), "served": pool.served} for pool in pools.values()}
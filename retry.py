@@ -0,0 +1,31 @@
+"""
+Retry budget shared by all API calls.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RetryBudget:
+	"""
+	Allow retries only up to a fraction of the calls made, so retries can't multiply the load on a struggling backend.
+	Each call deposits ratio tokens (up to maximum) and each retry spends one.
+	"""
+	def __init__(self, ratio: float, initial: float, maximum: float):
+		self.ratio = ratio
+		self.tokens = initial
+		self.maximum = maximum
+		self.retries = 0
+		self.denied = 0
+
+	def record_call(self):
+		self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+	def try_spend(self) -> bool:
+		"""Take a token for a retry, if there's one left"""
+		if self.tokens >= 1:
+			self.tokens -= 1
+			self.retries += 1
+			return True
+		self.denied += 1
+		logger.warning("Retry budget exhausted, not retrying")
+		return False
@@ -1,12 +1,21 @@
 import aiohttp
 import asyncio
 import dotenv
+import functions
+import health
 import logging
+import metrics
 import os
-import psutil
-import subprocess
+import random
+import signal
+import status
 import time
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
+
+if TYPE_CHECKING:
+	import psutil
+
+# The one place .env is loaded: both bot.py and cluster.py import this module before reading the environment
 dotenv.load_dotenv()
 logger = logging.getLogger('discord')
 
@@ -16,6 +25,19 @@ DOMESTIC_AI_PATH = os.environ['DOMESTIC_AI_PATH']
 API_HOST = "0.0.0.0"
 API_PORT = 8000
 API_ENDPOINT = "/api_endpoints"
+PROBE_INITIAL_DELAY = 0.25
+PROBE_MAX_DELAY = 5
+STOP_TIMEOUT = 5
+
+# Processes launched by this bot, by service name
+supervised: Dict[str, asyncio.subprocess.Process] = {}
+
+def backoff_delays(initial: float = PROBE_INITIAL_DELAY, maximum: float = PROBE_MAX_DELAY) -> Iterator[float]:
+	"""Exponential backoff delays with jitter: each delay is between half and all of the doubled step"""
+	delay = initial
+	while True:
+		yield delay / 2 + random.uniform(0, delay / 2)
+		delay = min(delay * 2, maximum)
 
 class Startup:
 	"""Class to represent a service (API or tool)"""
@@ -25,13 +47,15 @@ class Startup:
 				 host: str = "localhost", 
 				 endpoint: str = "/", 
 				 command_path: str = None,
-				 startup_timeout: int = STARTUP_TIMEOUT):
+				 startup_timeout: int = STARTUP_TIMEOUT,
+				 depends_on: Optional[List[str]] = None):
 		self.name = name
 		self.port = port
 		self.host = host
 		self.url = f"http://{host}:{port}{endpoint}"
 		self.command_path = command_path
 		self.startup_timeout = startup_timeout
+		self.depends_on = depends_on or []
 
 	async def is_running(self, session: aiohttp.ClientSession, timeout: int = 2) -> bool:
 		"""Check if the service is running"""
@@ -41,117 +65,221 @@ class Startup:
 		except (aiohttp.ClientError, asyncio.TimeoutError):
 			return False
 
-	async def start(self) -> bool:
+	async def start(self, session: Optional[aiohttp.ClientSession] = None) -> bool:
 		"""Start the service if it's not already running"""
 		if not self.command_path:
 			logger.warning(f"No command path specified for {self.name}, cannot start")
 			return False
 
 		try:
-			# Launch the service process in the background
-			subprocess.Popen(['bash', self.command_path], 
-							stdout=subprocess.DEVNULL,
-							stderr=subprocess.DEVNULL,
+			# Launch the service process in the background, in its own process group
+			process = await asyncio.create_subprocess_exec('bash', self.command_path,
+							stdout=asyncio.subprocess.DEVNULL,
+							stderr=asyncio.subprocess.DEVNULL,
 							start_new_session=True)
+			supervised[self.name] = process
 			
-			logger.info(f"Started {self.name} process with command: {self.command_path}")
+			logger.info(f"Started {self.name} process (PID: {process.pid}) with command: {self.command_path}")
 			
 			# Wait for service to become available
-			start_time = time.time()
-			while time.time() - start_time < self.startup_timeout:
+			if session is None:
 				async with aiohttp.ClientSession() as session:
-					if await self.is_running(session):
-						logger.info(f"{self.name} is now running")
-						return True
-				logger.info(f"Waiting for {self.name} to start...")
-				await asyncio.sleep(2)
-			
-			logger.error(f"{self.name} did not start within {self.startup_timeout} seconds")
-			return False
+					return await self.wait_until_running(session)
+			return await self.wait_until_running(session)
 		except Exception as e:
 			logger.error(f"Failed to start {self.name}: {e}")
 			return False
 
-	async def stop(self) -> bool:
-		"""Stop the service if it's running"""
+	async def wait_until_running(self, session: aiohttp.ClientSession) -> bool:
+		"""Probe the service with backoff until it answers or the startup timeout runs out"""
+		deadline = time.monotonic() + self.startup_timeout
+		for delay in backoff_delays():
+			if await self.is_running(session):
+				logger.info(f"{self.name} is now running")
+				return True
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			logger.info(f"Waiting for {self.name} to start...")
+			await asyncio.sleep(min(delay, remaining))
+		logger.error(f"{self.name} did not start within {self.startup_timeout} seconds")
+		return False
+
+	@property
+	def process(self) -> Optional[asyncio.subprocess.Process]:
+		"""The process launched for this service, if it's still alive"""
+		process = supervised.get(self.name)
+		if process is not None and process.returncode is None:
+			return process
+		return None
+
+	async def stop(self, listeners: Optional[Dict[int, "psutil.Process"]] = None) -> bool:
+		"""
+		Stop the service if it's running.
+		Processes launched by the bot are stopped directly; otherwise the process listening on the port is looked up,
+		in listeners if given or with a fresh connection snapshot.
+		"""
 		try:
-			# First try to find the process by port
-			process = find_process_by_port(self.port)
+			if self.process:
+				return await self._stop_supervised(self.process)
+			if listeners is None:
+				listeners = await asyncio.to_thread(find_processes_by_ports, [self.port])
+			process = listeners.get(self.port)
 			if process:
-				logger.info(f"Stopping {self.name} (PID: {process.pid})")
-				process.terminate()
-				try:
-					process.wait(timeout=5)
-				except psutil.TimeoutExpired:
-					logger.warning(f"Process {process.pid} didn't terminate, forcing kill")
-					process.kill()
-				logger.info(f"Successfully stopped {self.name}")
-				return True
+				return await self._stop_external(process)
 			else:
 				logger.warning(f"No process found using port {self.port} for {self.name}")
 				return False
 		except Exception as e:
 			logger.error(f"Error stopping {self.name}: {e}")
 			return False
-async def ensure_service_running(service: Startup, max_attempts: int = 5) -> bool:
+
+	async def _stop_supervised(self, process: asyncio.subprocess.Process) -> bool:
+		"""Stop a process launched by the bot, together with the children in its process group"""
+		logger.info(f"Stopping {self.name} (PID: {process.pid})")
+		try:
+			os.killpg(process.pid, signal.SIGTERM)
+			try:
+				await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+			except asyncio.TimeoutError:
+				logger.warning(f"Process {process.pid} didn't terminate, forcing kill")
+				os.killpg(process.pid, signal.SIGKILL)
+				await process.wait()
+		except ProcessLookupError:
+			pass
+		supervised.pop(self.name, None)
+		logger.info(f"Successfully stopped {self.name}")
+		return True
+
+	async def _stop_external(self, process: "psutil.Process") -> bool:
+		"""Stop a process found by port, without blocking the event loop"""
+		import psutil
+		logger.info(f"Stopping {self.name} (PID: {process.pid})")
+		process.terminate()
+		_, alive = await asyncio.to_thread(psutil.wait_procs, [process], STOP_TIMEOUT)
+		for proc in alive:
+			logger.warning(f"Process {proc.pid} didn't terminate, forcing kill")
+			proc.kill()
+		logger.info(f"Successfully stopped {self.name}")
+		return True
+
+async def ensure_service_running(service: Startup, max_attempts: int = 5, session: Optional[aiohttp.ClientSession] = None) -> bool:
 	"""Ensure a service is running, attempting to start it if needed"""
+	if session is None:
+		async with aiohttp.ClientSession() as session:
+			return await ensure_service_running(service, max_attempts, session)
+
 	# First check if it's already running
 	logger.info(f"Checking if {service.name} is available...")
-	
+	delays = backoff_delays()
 	for attempt in range(max_attempts):
-		async with aiohttp.ClientSession() as session:
-			if await service.is_running(session):
-				logger.info(f"{service.name} is already running")
-				return True
+		if await service.is_running(session):
+			logger.info(f"{service.name} is already running")
+			return True
 		
 		if attempt < max_attempts - 1:
 			logger.info(f"{service.name} not available (attempt {attempt+1}/{max_attempts}), waiting...")
-			await asyncio.sleep(2)
+			await asyncio.sleep(next(delays))
 	
 	# Service is not running, try to start it
 	logger.info(f"{service.name} not available after {max_attempts} attempts, trying to start it")
-	return await service.start()
+	return await service.start(session)
 
 async def ensure_services_running(services: List[Startup]) -> Dict[str, bool]:
-	"""Ensure multiple services are running and return their status"""
-	results = {}
+	"""
+	Ensure multiple services are running and return their status.
+	Services are checked and started concurrently; a service waits only for the services in its depends_on.
+	"""
+	tasks: Dict[str, asyncio.Task] = {}
+	started_at = time.monotonic()
+
+	async def ensure(service: Startup, session: aiohttp.ClientSession) -> bool:
+		for dependency in service.depends_on:
+			if dependency in tasks and not await tasks[dependency]:
+				logger.warning(f"{service.name} depends on {dependency}, which is not running")
+		ready = await ensure_service_running(service, session=session)
+		elapsed = time.monotonic() - started_at
+		metrics.startup_seconds.set(service.name, value=elapsed)
+		if ready:
+			logger.info(f"{service.name} ready in {elapsed:.2f}s")
+			health.breaker(service.name).record_success()
+		else:
+			logger.error(f"{service.name} not ready after {elapsed:.2f}s")
+			# Opened for real, so half-open probes and the health monitor can close it later
+			health.breaker(service.name).trip()
+		return ready
+
+	# Calls to a service are refused until it is ready
 	for service in services:
-		results[service.name] = await ensure_service_running(service)
-	return results
+		health.breaker(service.name).hold()
+	async with aiohttp.ClientSession() as session:
+		for service in services:
+			tasks[service.name] = asyncio.create_task(ensure(service, session))
+		await asyncio.gather(*tasks.values())
+	return {name: task.result() for name, task in tasks.items()}
 
-def find_process_by_port(port: int) -> Optional[psutil.Process]:
-    """Find a process that is listening on the given port"""
+def find_processes_by_ports(ports: List[int]) -> Dict[int, "psutil.Process"]:
+    """Find the processes listening on the given ports, from a single system-wide connection snapshot"""
+    # psutil is only needed to stop services, so it isn't imported at startup
+    import psutil
+    found = {}
     try:
-        for proc in psutil.process_iter(['pid', 'name']):  # Remove 'connections' from here
+        connections = psutil.net_connections(kind='inet')
+    except psutil.AccessDenied:
+        # Listing every connection needs root on macOS, scan process by process instead
+        return scan_processes_for_ports(ports)
+    except Exception as e:
+        logger.error(f"Error in find_processes_by_ports: {e}")
+        return found
+    for conn in connections:
+        if conn.pid and conn.laddr and conn.laddr.port in ports and conn.status == psutil.CONN_LISTEN:
             try:
-                # Get connections separately for each process
-                connections = proc.connections(kind='inet')
-                for conn in connections:
-                    if conn.laddr.port == port:
-                        return proc
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                found.setdefault(conn.laddr.port, psutil.Process(conn.pid))
+            except psutil.NoSuchProcess:
                 pass
-    except Exception as e:
-        logger.error(f"Error in find_process_by_port: {e}")
-        return None
-    return None
+    return found
+
+def scan_processes_for_ports(ports: List[int]) -> Dict[int, "psutil.Process"]:
+    """Find the processes listening on the given ports by checking each process's connections"""
+    import psutil
+    found = {}
+    for proc in psutil.process_iter(['pid']):
+        try:
+            for conn in proc.net_connections(kind='inet'):
+                if conn.laddr and conn.laddr.port in ports and conn.status == psutil.CONN_LISTEN:
+                    found.setdefault(conn.laddr.port, proc)
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            pass
+        if len(found) == len(ports):
+            break
+    return found
+
+def find_process_by_port(port: int) -> Optional["psutil.Process"]:
+    """Find a process that is listening on the given port"""
+    return find_processes_by_ports([port]).get(port)
 
-async def stop_service(service: Startup) -> bool:
+async def stop_service(service: Startup, listeners: Optional[Dict[int, "psutil.Process"]] = None) -> bool:
     """Stop a specific service"""
     logger.info(f"Stopping service: {service.name}")
-    return await service.stop()
+    return await service.stop(listeners)
 
 async def stop_services(services: List[Startup]) -> Dict[str, bool]:
-    """Stop multiple services and return their status"""
-    results = {}
-    for service in services:
-        results[service.name] = await stop_service(service)
-    return results
+    """Stop multiple services in parallel and return their status"""
+    # Services the bot didn't launch are found by port, from one shared snapshot
+    external_ports = [service.port for service in services if not service.process]
+    listeners = await asyncio.to_thread(find_processes_by_ports, external_ports) if external_ports else {}
+    results = await asyncio.gather(*(stop_service(service, listeners) for service in services))
+    return {service.name: result for service, result in zip(services, results)}
 
 async def stop_all_services() -> bool:
     """Stop all services (API and tools)"""
+    if not status.get_state("service-owner"):
+        # Cluster workers leave the services to the coordinator
+        await functions.close_session()
+        return True
     logger.info("Stopping all services...")
     results = await stop_services(services)
+    await functions.close_session()
     return all(results.values())
 
 # New function to stop specific service types
@@ -203,5 +331,7 @@ async def start_tools():
 # A new unified function that handles both API and tools
 async def ensure_all_services():
 	"""Ensure all services (API and tools) are running"""
+	started_at = time.monotonic()
 	results = await ensure_services_running(services)
+	metrics.startup_seconds.set("all services", value=time.monotonic() - started_at)
 	return all(results.values())
\ No newline at end of file
@@ -5,10 +5,145 @@ The set of statuses used by the bot.
 state = {
 	"prefix" : "roby ", 
 	"API-url" : "http://0.0.0.0:8000/", 
+	"API-pool-size" : 100, # total connections kept by the shared API session
+	"API-pool-size-per-host" : 20, # connections per host (API and tools)
+	"API-keepalive" : 30, # seconds an idle connection is kept open
+	"API-dns-ttl" : 300, # seconds a DNS lookup is cached
+	"API-timeout" : 120, # default total timeout in seconds for an API call
+	# Timeout in seconds per endpoint prefix (longest match wins, API-timeout otherwise)
+	"endpoint-timeouts" : {
+		"api/beep" : 5,
+		"api/bop" : 5,
+		"api/flip" : 5,
+		"api/ping" : 5,
+		"api/throw" : 5,
+		"api/btc" : 10,
+		"api/eth" : 10,
+		"endpoints" : 10,
+		"api/rembg" : 120,
+		"api/roby" : 180,
+		"api/image" : 600,
+	},
+	# POST endpoints that are safe to retry (GET requests always are)
+	"idempotent-endpoints" : ["api/beep", "api/bop", "api/ping", "api/btc", "api/eth", "api/thanks"],
+	"retry-attempts" : 2, # retries after the first attempt of an idempotent call
+	"retry-delay" : 0.2, # seconds before the first retry, doubled for each next one
+	"retry-budget-ratio" : 0.1, # retries allowed per call made
+	"retry-budget-max" : 10, # most retries that can be saved up
+	"quote-ttl" : 15, # seconds a /btc or /eth quote is served from cache
+	"quote-stale-ttl" : 45, # extra seconds a stale quote is served while it refreshes
+	# Endpoints where identical concurrent calls share one upstream call.
+	# Keep out endpoints where each call must be random (e.g. api/flip, api/throw).
+	"coalesce-endpoints" : ["api/haiku", "api/roby", "api/image", "api/rembg"],
+	"jobs-enabled" : True, # submit /image as a job and poll it, when the API supports it
+	"job-poll-interval" : 2, # seconds between job status polls
+	"job-request-timeout" : 10, # timeout in seconds for each job submit/poll request
+	"job-timeout" : 840, # give up on a job after this many seconds (interaction tokens last 15 minutes)
+	"job-support-recheck" : 600, # seconds before asking again an endpoint that didn't support jobs
+	"roby-streaming" : True, # stream /roby answers into the reply as they're generated
+	"stream-edit-interval" : 1.5, # minimum seconds between edits of a streamed reply (Discord rate limits)
+	# Service behind each endpoint prefix, for the circuit breakers (anything else is the API)
+	"endpoint-services" : {
+		"api/image" : "Image Generation Tool",
+		"api/rembg" : "Rembg Tool",
+	},
+	"health-interval" : 15, # seconds between health checks of the services
+	# Seconds a health probe waits for an answer, and failed probes in a row before a restart, by service.
+	# A long generation can keep the image tool from answering, and in a cluster the coordinator can't see the workers' calls
+	"probe-timeouts" : {
+		"Image Generation Tool" : 10,
+	},
+	"restart-after" : {
+		"Image Generation Tool" : 12,
+	},
+	"breaker-failure-threshold" : 3, # consecutive failures before a service's circuit opens
+	"breaker-reset-timeout" : 30, # seconds before an open circuit lets a call through again
+	"auto-restart" : True, # restart services that stop responding
+	"restart-initial-delay" : 30, # seconds before retrying a failed restart, doubled each time
+	"restart-max-delay" : 600,
+	"metrics-port" : 9108, # local port for the Prometheus metrics, None to disable
+	"tree-fingerprint-path" : ".tree-fingerprint.json", # hash of the last synced command tree
+	"force-sync" : False, # sync the command tree even if it didn't change (--sync)
+	"dev-guild-id" : None, # sync commands to this guild only, for development (--guild)
+	"catalogue-path" : ".endpoint-catalogue.json", # last endpoint catalogue, for fast cold boots
+	"catalogue-interval" : 300, # seconds between endpoint catalogue reloads
+	"result-cache-enabled" : True, # keep /rembg results and fixed-seed /image results on disk
+	"result-cache-path" : ".result-cache",
+	"result-cache-max-bytes" : 1024 * 1024 * 1024, # least recently used results are evicted past this size
+	"rembg-upload" : True, # send the image bytes to the Rembg tool instead of a url it has to download
+	"rembg-max-bytes" : 10 * 1024 * 1024, # larger source images are rejected
+	"rembg-max-dimension" : 2048, # larger images are downscaled by Discord's media proxy first
+	"rembg-formats" : ["image/png", "image/jpeg", "image/webp"],
+	# Cheap endpoints that skip the service queues
+	"fast-endpoints" : ["api/beep", "api/bop", "api/flip", "api/ping", "api/throw", "api/thanks", "api/btc", "api/eth"],
+	"user-rate" : 0.2, # API calls per second per user, on average
+	"user-burst" : 5, # API calls a user can make at once
+	"guild-rate" : 2, # API calls per second per guild, on average
+	"guild-burst" : 30,
+	# Concurrent heavy calls per service (API for any service not listed)
+	"service-concurrency" : {
+		"API" : 4,
+		"Rembg Tool" : 2,
+		"Image Generation Tool" : 1,
+	},
+	"queue-limit" : 50, # calls waiting per service before new ones are turned away
+	"pregen-enabled" : True, # serve slow answers from pools refilled in the background
+	"pregen-endpoints" : ["api/joke", "api/wisdom", "api/wdyt", "api/haiku"],
+	# Payloads to always keep a pool for, by endpoint (endpoints not listed get a pool for calls without arguments)
+	"pregen-params" : {
+		"api/haiku" : [],
+	},
+	"pregen-top-params" : 3, # also keep pools for the most asked for payloads of each endpoint
+	"pregen-size" : 3, # answers kept ready per pool
+	"pregen-refill-per-tick" : 1, # answers generated per routine_function run
+	"pregen-no-repeat" : 20, # recent answers a pool won't serve again
+	"sharded" : False, # run an AutoShardedBot, one gateway connection per shard
+	"shard-count" : None, # total shards, None for Discord's recommendation
+	"shard-ids" : None, # shards run by this process, None for all of them
+	"cluster-workers" : 2, # processes cluster.py spreads the shards across
+	"cluster-worker" : None, # index of this process in the cluster, None when not in one
+	"service-owner" : True, # start, restart and stop the services (the coordinator's job in a cluster)
+	"shard-latency-interval" : 60, # seconds between per-shard gateway latency reports
+	"warmup-enabled" : True, # keep the models of warmup-endpoints loaded while they're in use, see warmup.py
+	# Model-backed endpoints: the cheap call that loads the model, and the seconds the backend keeps it loaded without calls
+	# ("image" : True for calls answered with an image, "warm-up" : False to only report cold and warm latency)
+	"warmup-endpoints" : {
+		"api/roby" : {"params" : {"prompt" : "Hi"}, "unload-after" : 300},
+		"api/haiku" : {"params" : None, "unload-after" : 300},
+		# No load-only call for the diffusion model: a warm-up would be a full generation holding the tool's only slot,
+		# so image latency is only reported, not kept warm
+		"api/image" : {"params" : None, "unload-after" : 600, "warm-up" : False},
+	},
+	"warmup-lead" : 30, # seconds before the model would be unloaded that the warm-up is sent
+	"warmup-recent-use" : 1800, # seconds after a command that its model is kept warm
+	"warmup-active-share" : 0.25, # hours with at least this share of the busiest hour's commands are active
+	"warmup-max-backoff" : 4, # most times the wait between unused warm-ups doubles during active hours
+	# Services that report their queue, with the path of the report: no warm-up is sent while one of them is busy,
+	# since they share the machine with the models
+	"warmup-busy-checks" : {
+		"Image Generation Tool" : "/queue-status",
+	},
+	"cache-profile" : "lean", # gateway cache profile, from cache-profiles (see gateway.py)
+	"cache-profiles" : {
+		# Only what the commands use: slash commands, plus message content for the prefix commands
+		"lean" : {
+			"intents" : ["guilds", "guild_messages", "dm_messages", "message_content"],
+			"member-cache" : [],
+			"max-messages" : None,
+			"chunk-guilds-at-startup" : False,
+		},
+		# Every default cache, with full member lists downloaded on connect
+		"full" : {
+			"intents" : ["default", "members", "message_content"],
+			"member-cache" : ["voice", "joined"],
+			"max-messages" : 1000,
+			"chunk-guilds-at-startup" : True,
+		},
+	},
 }
 
 def get_state(key):
 	return state[key]
 
 def set_state(key, value):
-	state[key] = value
\ No newline at end of file
+	state[key] = value
@@ -0,0 +1,174 @@
+"""
+Warm-keeping of the model-backed endpoints.
+
+The backend unloads its models (LLM, diffusion) after some time without calls, and the next call waits for them
+to load again. tick() sends a cheap call to an endpoint shortly before its model would be unloaded, when it's worth it:
+- after recent use the model is kept warm
+- during active hours, learnt from when commands come in, it's kept warm with backoff:
+  each warm-up that no command follows doubles the wait before the next one
+- otherwise the model is left to unload, to save energy
+Warm-ups skip busy services, and any warm-up is skipped while the image tool (on the same machine) reports work. Commands record whether they found their model cold or warm, and how long they took.
+"""
+import admission
+import aiohttp
+import asyncio
+import health
+import logging
+import metrics
+import pregen
+import status
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DECAY = 0.5 # weight left to the past days' commands at each new day
+QUEUE_STATUS_TIMEOUT = 2
+# Fields of a queue status report that are non-zero while the service is working.
+# The report has no documented schema: one with none of these fields counts as busy
+BUSY_FIELDS = ("busy", "queue_size", "queue_length", "queued", "pending", "running", "processing", "in_progress", "active")
+
+# Time of the last call to each endpoint, from commands, pre-generation or warm-ups
+last_call: Dict[str, float] = {}
+# Time of the last call made by a command, by endpoint
+last_use: Dict[str, float] = {}
+# Commands calling the model-backed endpoints by hour of the day, decayed daily
+hourly_use: List[float] = [0.0] * 24
+history_day: Optional[int] = None
+# Warm-ups sent since the endpoint was last used, for the backoff
+idle_warmups: Dict[str, int] = {}
+warming: Dict[str, asyncio.Task] = {}
+# Whether a command found its model cold or warm: interaction id -> (endpoint, "cold" or "warm", time of the call)
+classified: Dict[int, Tuple[str, str, float]] = {}
+# (count, total seconds) of the commands, by (endpoint, "cold" or "warm")
+latencies: Dict[Tuple[str, str], Tuple[int, float]] = {}
+
+def _age_history():
+	global history_day
+	today = time.localtime().tm_yday
+	if history_day is not None and today != history_day:
+		for hour in range(24):
+			hourly_use[hour] *= HISTORY_DECAY
+	history_day = today
+
+def called(endpoint: str):
+	"""Record a call to an endpoint, and for a command's first call whether it found the model warm"""
+	now = time.monotonic()
+	previous = last_call.get(endpoint)
+	last_call[endpoint] = now
+	config = status.get_state("warmup-endpoints").get(endpoint)
+	interaction = admission.current_interaction.get()
+	if config is None or interaction is None:
+		return
+	last_use[endpoint] = now
+	idle_warmups.pop(endpoint, None)
+	_age_history()
+	hourly_use[time.localtime().tm_hour] += 1
+	for interaction_id, (_, _, called_at) in list(classified.items()):
+		if now - called_at > metrics.STALE_AFTER:
+			del classified[interaction_id]
+	if interaction.id not in classified:
+		warm = previous is not None and now - previous < config["unload-after"]
+		classified[interaction.id] = (endpoint, "warm" if warm else "cold", now)
+
+def command_finished(interaction, error: bool = False):
+	"""Record the latency of a command that called a model-backed endpoint (before metrics.command_finished)"""
+	entry = classified.pop(interaction.id, None)
+	latency = metrics.command_latency(interaction)
+	if entry is None or error or latency is None:
+		return
+	endpoint, model, _ = entry
+	metrics.model_command_seconds.observe(endpoint, model, value=latency)
+	count, total = latencies.get((endpoint, model), (0, 0.0))
+	latencies[(endpoint, model)] = (count + 1, total + latency)
+
+def active_hour() -> bool:
+	"""Whether this hour or the next usually sees a good share of the busiest hour's commands"""
+	_age_history()
+	peak = max(hourly_use)
+	hour = time.localtime().tm_hour
+	return peak > 0 and max(hourly_use[hour], hourly_use[(hour + 1) % 24]) >= status.get_state("warmup-active-share") * peak
+
+def warmup_after(endpoint: str, config: dict, now: float) -> Optional[float]:
+	"""Seconds after the last call to send a warm-up, or None to let the model unload"""
+	period = config["unload-after"] - status.get_state("warmup-lead")
+	if now - last_use.get(endpoint, float("-inf")) < status.get_state("warmup-recent-use"):
+		return period
+	if active_hour():
+		return period * 2 ** min(idle_warmups.get(endpoint, 0), status.get_state("warmup-max-backoff"))
+	return None
+
+def queue_busy(report) -> bool:
+	"""Whether a queue status report shows queued or running jobs, or can't be read"""
+	if not isinstance(report, dict) or not any(field in report for field in BUSY_FIELDS):
+		logger.warning(f"Unrecognised queue status report, counting the service as busy: {report!r:.200}")
+		return True
+	return any(report.get(field) for field in BUSY_FIELDS)
+
+async def service_busy(endpoint: str, services: List, session: aiohttp.ClientSession) -> bool:
+	"""
+	Whether the endpoint's service is handling calls,
+	or one of the services in warmup-busy-checks (whatever the endpoint) reports a queue or is down
+	"""
+	if not pregen.backend_idle(endpoint):
+		return True
+	for name, path in status.get_state("warmup-busy-checks").items():
+		service = next((service for service in services if service.name == name), None)
+		if service is None:
+			continue
+		try:
+			async with session.get(f"http://{service.host}:{service.port}{path}", timeout=aiohttp.ClientTimeout(total=QUEUE_STATUS_TIMEOUT)) as response:
+				if queue_busy(await response.json(content_type=None)):
+					return True
+		except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+			logger.warning(f"Could not read the queue status of {name}: {e}")
+			return True
+	return False
+
+async def warm(endpoint: str, call: Callable[[str, Optional[dict]], Awaitable]):
+	started_at = time.monotonic()
+	try:
+		await call(endpoint, status.get_state("warmup-endpoints")[endpoint]["params"])
+	except Exception as e:
+		logger.warning(f"Warm-up of {endpoint} failed: {e}")
+		return
+	idle_warmups[endpoint] = idle_warmups.get(endpoint, 0) + 1
+	metrics.warmups_total.inc(endpoint)
+	logger.info(f"Warmed up {endpoint} in {time.monotonic() - started_at:.2f}s")
+
+async def tick(post: Callable[[str, Optional[dict]], Awaitable], post_image: Callable[[str, Optional[dict]], Awaitable], services: List, session: aiohttp.ClientSession) -> int:
+	"""
+	Start the warm-ups that are due, in the background. Returns how many were started.
+	post makes a live API call, post_image one to an image endpoint.
+	"""
+	# In a cluster the first worker warms the models for all of them
+	if not status.get_state("warmup-enabled") or status.get_state("cluster-worker") not in (None, 0):
+		return 0
+	started = 0
+	for endpoint, config in status.get_state("warmup-endpoints").items():
+		if not config.get("warm-up", True):
+			continue
+		if endpoint in warming and not warming[endpoint].done():
+			continue
+		now = time.monotonic()
+		after = warmup_after(endpoint, config, now)
+		if after is None or now - last_call.get(endpoint, float("-inf")) < after:
+			continue
+		if await service_busy(endpoint, services, session):
+			logger.info(f"Skipping the warm-up of {endpoint}, its service is busy or down")
+			continue
+		warming[endpoint] = asyncio.create_task(warm(endpoint, post_image if config.get("image") else post))
+		started += 1
+	return started
+
+def stats() -> Dict[str, Dict[str, str]]:
+	"""Average command latency with a cold and a warm model, and warm-ups sent, by endpoint"""
+	result = {}
+	for endpoint in status.get_state("warmup-endpoints"):
+		entry = {}
+		for model in ("cold", "warm"):
+			count, total = latencies.get((endpoint, model), (0, 0.0))
+			entry[model] = f"{total / count:.1f}s ({count})" if count else "-"
+		entry["warm-ups"] = str(int(metrics.warmups_total.values.get((endpoint,), 0)))
+		result[endpoint] = entry
+	return result